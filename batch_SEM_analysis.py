@@ -1,74 +1,977 @@
+import os
+import json
+import time
+import cProfile
+import numpy as np
 import src.fileIO as io
 import src.filepaths as fp
 import src.analysis as anal
+import src.cache as cache
+import src.store as store
+import src.staging as staging
+import src.plotting as plot
+import src.instrument as instrument
 
 from pathlib import Path
+from collections import deque
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    FIRST_COMPLETED,
+    as_completed,
+    wait)
+from concurrent.futures.process import BrokenProcessPool
+
+
+def load_image_inputs(parent_directory,
+                      file_path,
+                      directory_paths,
+                      log_index=None):
+    '''
+    Read an image's sample information, SEM log and region of interest, the
+    file reading part of image_grating_frequency. If directory_paths has a
+    "Stage Path", the image and log are read from local staged copies (see
+    src.staging), copied there first if they are not staged yet.
+    Args:
+        parent_directory: <string> parent directory identifier
+        file_path: <string> path to image file
+        directory_paths: <dict> dictionary containing required paths
+        log_index: <dict> SEM log index from fp.build_log_index, searches the
+                    SEM path if None
+    Returns:
+        image_inputs: <dict> "Sample Parameters", "Log Parameters" and, if a
+                        log file was found, "Image Parameters" and
+                        "Grating Region" (see io.read_image_region)
+    '''
+    sample_parameters = fp.sample_information(file_path=file_path)
+    with instrument.stage('Log Search'):
+        log_path, log_parameters = fp.find_semlog(
+            log_path=directory_paths['SEM Path'],
+            sample_details=sample_parameters,
+            file_string='.txt',
+            log_index=log_index)
+    image_inputs = {
+        'Sample Parameters': sample_parameters,
+        'Log Parameters': log_parameters}
+    if len(log_path) == 0:
+        return image_inputs
+    image_path = file_path
+    log_path = log_path[0]
+    stage_path = directory_paths.get('Stage Path')
+    if stage_path is not None:
+        with instrument.stage('Staging'):
+            image_path = staging.stage_file(
+                stage_path=stage_path,
+                file_path=image_path)
+            log_path = staging.stage_file(
+                stage_path=stage_path,
+                file_path=log_path)
+    with instrument.stage('Log Parse'):
+        image_inputs['Image Parameters'] = io.read_SEM_log(
+            file_path=log_path)
+    with instrument.stage('Image Load'):
+        image_inputs['Grating Region'] = io.read_image_region(
+            file_path=image_path,
+            height=image_inputs['Image Parameters']['image_height'],
+            width=image_inputs['Image Parameters']['image_width'])
+    return image_inputs
+
+
+def image_grating_frequency(parent_directory,
+                            batch_name,
+                            file_path,
+                            directory_paths,
+                            plot_files,
+                            log_index=None,
+                            spectrum_mode='Rows',
+                            fill_factor='False',
+                            plot_dpi=600,
+                            plot_methods='All',
+                            image_inputs=None):
+    '''
+    Calculate grating frequency and period of a single image for optimised
+    data thresholding, and optionally the grating fill factor. If
+    directory_paths has a "Cache Path", results are looked up in (and saved
+    to) the content-addressed result cache. Each stage is timed with
+    instrument.stage. The image and log are read here unless they have
+    already been read (prefetched) into image_inputs.
+    Args:
+        parent_directory: <string> parent directory identifier
+        batch_name: <string> batch name string
+        file_path: <string> path to image file
+        directory_paths: <dict> dictionary containing required paths
+        plot_files: <string> "True" or "False" for plotting output
+        log_index: <dict> SEM log index from fp.build_log_index, built from the
+                    SEM path if None
+        spectrum_mode: <string> "Rows" or "Averaged" (fast mode) spectrum
+                        analysis, see anal.multi_threshold_grating_frequency
+        fill_factor: <string> "True" or "False" for fill factor analysis, see
+                        anal.grating_fill_factor
+        plot_dpi: <int> plot resolution in dots per inch
+        plot_methods: <string> "All" or "Selected" thresholding methods to plot
+        image_inputs: <dict> as load_image_inputs, or the error raised while
+                        loading them, None reads the image and log here
+    Returns:
+        image_dictionary: <dict> image, log, and results entries for the batch
+                            dictionary, empty if there is no log file
+        period_dictionary: <dict> secondary string: grating period, empty if
+                            there is no log file
+    '''
+    if image_inputs is None:
+        image_inputs = load_image_inputs(
+            parent_directory=parent_directory,
+            file_path=file_path,
+            directory_paths=directory_paths,
+            log_index=log_index)
+    if isinstance(image_inputs, Exception):
+        raise image_inputs
+    if 'Grating Region' not in image_inputs:
+        return {}, {}
+    sample_parameters = image_inputs['Sample Parameters']
+    log_parameters = image_inputs['Log Parameters']
+    image_parameters = image_inputs['Image Parameters']
+    grating_region = image_inputs['Grating Region']
+    distanceperpixel = anal.calc_distance_per_pixel(
+        distance_value=image_parameters['calibration_distance'],
+        distance_unit=image_parameters['distance_unit'],
+        number_of_pixels=image_parameters['calibration_pixels'])
+    out_string = sample_parameters[f'{parent_directory} Secondary String']
+    design_period = sample_parameters[f'{parent_directory} Design Period']
+    analysis_parameters = {
+        'distance_per_pixel': distanceperpixel,
+        'sample_name': out_string,
+        'design_period': int(design_period),
+        'plot_files': plot_files,
+        'out_path': Path(
+            f'{directory_paths["Results Path"]}'
+            f'/{batch_name}_{out_string}'),
+        'spectrum_mode': spectrum_mode,
+        'plot_dpi': plot_dpi,
+        'plot_methods': plot_methods}
+    cache_path = directory_paths.get('Cache Path')
+    results_dictionary = None
+    if cache_path is not None:
+        with instrument.stage('Cache Lookup'):
+            key = cache.cache_key(
+                image=grating_region,
+                image_parameters=image_parameters,
+                analysis_parameters=dict(
+                    analysis_parameters,
+                    fill_factor=fill_factor))
+            results_dictionary = cache.load_cached_results(
+                cache_path=cache_path,
+                key=key)
+    if results_dictionary is None:
+        with instrument.stage('Analysis'):
+            results_dictionary = anal.calculate_grating_frequency(
+                grating_region=grating_region,
+                **analysis_parameters)
+        if fill_factor == 'True':
+            with instrument.stage('Fill Factor'):
+                results_dictionary.update(
+                    anal.grating_fill_factor(
+                        grating=grating_region,
+                        distance_per_pixel=distanceperpixel,
+                        grating_period=results_dictionary[
+                            f'{out_string} Grating Period'],
+                        sample_name=out_string))
+        if cache_path is not None:
+            with instrument.stage('Cache Save'):
+                cache.save_cached_results(
+                    cache_path=cache_path,
+                    key=key,
+                    results=results_dictionary)
+    image_dictionary = {
+        f'{out_string} Image': sample_parameters,
+        f'{out_string} Log File': log_parameters,
+        f'{out_string} Log': image_parameters}
+    image_dictionary.update(results_dictionary)
+    period_dictionary = {
+        f'{out_string}': results_dictionary[f'{out_string} Grating Period']}
+    return image_dictionary, period_dictionary
+
+
+def image_error(file_path,
+                error):
+    '''
+    Batch dictionary entry recording a failed image analysis.
+    Args:
+        file_path: <string> path to image file
+        error: <Exception> error raised by the analysis
+    Returns:
+        error_dictionary: <dict> '{file name} Error': error description
+    '''
+    file_name = fp.get_filename(file_path=file_path)
+    print(f'{file_name} failed: {type(error).__name__}: {error}')
+    return {f'{file_name} Error': f'{type(error).__name__}: {error}'}
+
+
+def read_ahead_image_inputs(**kwargs):
+    '''
+    Load an image's inputs on a background reading thread. The region of
+    interest is copied into memory, so the file is read now rather than when
+    the memory mapped pixels are first used by the analysis. Errors are
+    returned rather than raised, to be reported against the image.
+    Args:
+        kwargs: load_image_inputs arguments
+    Returns:
+        image_inputs: <dict> as load_image_inputs, or the error raised
+        load_timings: <dict> stage timings of the loading, see
+                        instrument.stage_timings
+    '''
+    instrument.reset_stages()
+    try:
+        image_inputs = load_image_inputs(**kwargs)
+        if 'Grating Region' in image_inputs:
+            with instrument.stage('Image Load'):
+                image_inputs['Grating Region'] = np.array(
+                    image_inputs['Grating Region'])
+    except Exception as error:
+        image_inputs = error
+    return image_inputs, instrument.stage_timings()
+
+
+def prefetch_image_inputs(file_paths,
+                          prefetch,
+                          **kwargs):
+    '''
+    Read images and their SEM logs on background threads, ahead of the image
+    being analysed, so file reads (e.g. from a network share) overlap with
+    the analysis. At most prefetch images are read ahead, so memory stays
+    bounded however long the batch is.
+    Args:
+        file_paths: <array> array of target file paths, in analysis order
+        prefetch: <int> maximum number of images read ahead
+        kwargs: remaining load_image_inputs arguments
+    Returns:
+        prefetched_files: <generator> (file path, (image_inputs, load_timings))
+                            in file path order, see read_ahead_image_inputs.
+                            Time spent waiting for a read is added to the
+                            load timings as the "I/O Wait" stage
+    '''
+    file_paths = iter(file_paths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=prefetch) as loader:
+        while True:
+            while len(pending) <= prefetch:
+                file = next(file_paths, None)
+                if file is None:
+                    break
+                pending.append((file, loader.submit(
+                    read_ahead_image_inputs,
+                    file_path=file,
+                    **kwargs)))
+            if len(pending) == 0:
+                return
+            file, future = pending.popleft()
+            wait_start = time.perf_counter()
+            image_inputs, load_timings = future.result()
+            load_timings['I/O Wait'] = {
+                'Wall Time': time.perf_counter() - wait_start,
+                'CPU Time': None,
+                'Peak Memory': None}
+            yield file, (image_inputs, load_timings)
+
+
+def isolated_image_grating_frequency(file_path,
+                                     profile_path=None,
+                                     prefetched=None,
+                                     **kwargs):
+    '''
+    Run image_grating_frequency, catching any error so that one failing image
+    does not stop the rest of the batch, and collect the image's stage
+    timings. Plots render in the background, so the Plotting stage is the
+    render time of plots that finished while this image was analysed.
+    Args:
+        file_path: <string> path to image file
+        profile_path: <string> if given, the analysis is run under cProfile
+                        and the profile saved to this path (read with pstats)
+        prefetched: <tuple> (image_inputs, load_timings) as yielded by
+                    prefetch_image_inputs, None reads the image here. The
+                    load timings are added to the image's timings
+        kwargs: remaining image_grating_frequency arguments
+    Returns:
+        image_dictionary: <dict> as image_grating_frequency, or a single
+                            '{file name} Error' entry if the analysis failed
+        period_dictionary: <dict> as image_grating_frequency, empty if the
+                            analysis failed
+        timing_dictionary: <dict> stage name: wall time, CPU time and peak
+                            memory, see instrument.stage_timings
+    '''
+    instrument.reset_stages()
+    if prefetched is not None:
+        image_inputs, load_timings = prefetched
+        kwargs['image_inputs'] = image_inputs
+        for stage_name, timings in load_timings.items():
+            instrument.record_stage(
+                stage_name=stage_name,
+                wall_time=timings['Wall Time'],
+                cpu_time=timings['CPU Time'],
+                memory=timings['Peak Memory'])
+    render_start = plot.render_time
+    profiler = cProfile.Profile() if profile_path is not None else None
+    try:
+        if profiler is None:
+            image_results = image_grating_frequency(
+                file_path=file_path,
+                **kwargs)
+        else:
+            image_results = profiler.runcall(
+                image_grating_frequency,
+                file_path=file_path,
+                **kwargs)
+    except Exception as error:
+        image_results = image_error(file_path=file_path, error=error), {}
+    if profiler is not None:
+        profiler.dump_stats(profile_path)
+    if plot.render_time > render_start:
+        instrument.record_stage(
+            stage_name='Plotting',
+            wall_time=plot.render_time - render_start)
+    return image_results + (instrument.stage_timings(), )
+
+
+def evict_directories(directory_paths,
+                      cache_size,
+                      stage_size):
+    '''
+    Evict the least recently used entries of the result cache and staging
+    directory (if they are used) down to their sizes. Each is scanned once,
+    so call this once a batch rather than after every image.
+    Args:
+        directory_paths: <dict> dictionary containing required paths
+        cache_size: <int> maximum result cache size in bytes
+        stage_size: <int> maximum staging directory size in bytes
+    Returns:
+        None
+    '''
+    if Path(f'{directory_paths.get("Cache Path")}').is_dir():
+        cache.evict_cache(
+            cache_path=directory_paths['Cache Path'],
+            cache_size=cache_size)
+    if Path(f'{directory_paths.get("Stage Path")}').is_dir():
+        cache.evict_cache(
+            cache_path=directory_paths['Stage Path'],
+            cache_size=stage_size,
+            file_string='.stage')
+
+
+def file_status(file_path):
+    '''
+    Size and modification time of an image file, recorded with its results so
+    a changed image is analysed again rather than resumed.
+    Args:
+        file_path: <string> path to image file
+    Returns:
+        status: <dict> "File Size" in bytes and "File Time" (modification
+                time in ns), None values if the file can not be read
+    '''
+    try:
+        status = os.stat(file_path)
+    except OSError:
+        return {'File Size': None, 'File Time': None}
+    return {'File Size': status.st_size, 'File Time': status.st_mtime_ns}
+
+
+def image_record(file_path,
+                 image_results):
+    '''
+    Results stream record for one analysed image.
+    Args:
+        file_path: <string> path to image file
+        image_results: <tuple> (image_dictionary, period_dictionary,
+                        timing_dictionary) as returned by
+                        isolated_image_grating_frequency
+    Returns:
+        record: <dict> file path, file size and modification time (see
+                file_status), image dictionary, period dictionary and stage
+                timings
+    '''
+    image_dictionary, period_dictionary, timing_dictionary = image_results
+    record = {'File Path': f'{file_path}'}
+    record.update(file_status(file_path=file_path))
+    record.update({
+        'Image': image_dictionary,
+        'Periods': period_dictionary,
+        'Timing': timing_dictionary})
+    return record
+
+
+def unchanged_image(record):
+    '''
+    Check an image record's file is unchanged since it was analysed: the same
+    size and modification time. Records without them (older streams) count as
+    changed.
+    Args:
+        record: <dict> image record, see image_record
+    Returns:
+        unchanged: <bool> True if the results are still current
+    '''
+    if record.get('File Size') is None:
+        return False
+    status = file_status(file_path=record['File Path'])
+    return (
+        status['File Size'] == record['File Size']
+        and status['File Time'] == record.get('File Time'))
+
+
+def batch_stream_record(batch_dictionary,
+                        file_paths,
+                        plot_files,
+                        spectrum_mode,
+                        fill_factor,
+                        shard_paths=None):
+    '''
+    First record of a batch results stream, identifying the batch files, the
+    analysis settings and the analysis code version.
+    Args:
+        batch_dictionary: <dict> batch entries from fp.update_batch_dictionary
+        file_paths: <array> array of batch file paths
+        plot_files: <string> "True" or "False" for plotting output
+        spectrum_mode: <string> "Rows" or "Averaged" spectrum analysis
+        fill_factor: <string> "True" or "False" for fill factor analysis
+        shard_paths: <array> file paths analysed by this shard, None if the
+                        whole batch is analysed
+    Returns:
+        batch_record: <dict> batch, file paths, settings (and shard paths)
+    '''
+    batch_record = {
+        'Batch': batch_dictionary,
+        'File Paths': [f'{file}' for file in file_paths],
+        'Settings': {
+            'Plot Files': plot_files,
+            'Spectrum Mode': spectrum_mode,
+            'Fill Factor': fill_factor,
+            'Code Version': cache.code_version()}}
+    if shard_paths is not None:
+        batch_record['Shard Paths'] = [f'{file}' for file in shard_paths]
+    return batch_record
+
+
+def rebuild_batch_dictionary(records):
+    '''
+    Rebuild the batch results dictionary (the _Period.json layout) from a
+    results stream. Image entries are ordered by the batch file paths, as in
+    batch_grating_frequency, whatever order the images finished in. Only the
+    records after the last batch record are used.
+    Args:
+        records: <array> results stream records, see batch_grating_frequency
+    Returns:
+        batch_dictionary: <dict> batch, image, log, and results entries with
+                            the batch average grating periods, if the stream
+                            has a summary record
+    '''
+    batch_dictionary = {}
+    file_paths = []
+    images = {}
+    summary = {}
+    for record in records:
+        if 'Batch' in record:
+            batch_dictionary = dict(record['Batch'])
+            file_paths = record['File Paths']
+            images = {}
+            summary = {}
+        elif 'File Path' in record:
+            images[record['File Path']] = record['Image']
+        elif 'Summary' in record:
+            summary = record['Summary']
+    for file in file_paths:
+        batch_dictionary.update(images.get(file, {}))
+    batch_dictionary.update(summary)
+    return batch_dictionary
+
+
+def load_checkpoint(stream_path,
+                    batch_record):
+    '''
+    Images already analysed by an interrupted run of a batch, read back from
+    its results stream. The stream is only a checkpoint for this run if its
+    last batch record matches this run's batch record, i.e. the same files
+    analysed with the same settings and analysis code, and that run did not
+    finish (no summary record after it). A finished batch is run again so
+    its images go through the result cache. Images whose file size or
+    modification time has changed since they were recorded are left out, so
+    they are analysed again.
+    Args:
+        stream_path: <string> path to results stream file
+        batch_record: <dict> batch record for this run
+    Returns:
+        finished_images: <dict> file path string: (image_dictionary,
+                            period_dictionary, timing_dictionary) for every
+                            finished image, None if the stream is missing or
+                            from another run
+    '''
+    if not Path(stream_path).is_file():
+        return None
+    records = io.load_json_records(file_path=stream_path)
+    batch_records = [
+        index for index, record in enumerate(records) if 'Batch' in record]
+    if len(batch_records) == 0:
+        return None
+    batch_record = json.loads(json.dumps(batch_record, default=io.convert))
+    if records[batch_records[-1]] != batch_record:
+        return None
+    run_records = records[batch_records[-1]:]
+    if any('Summary' in record for record in run_records):
+        return None
+    return {
+        record['File Path']: (
+            record['Image'],
+            record['Periods'],
+            record.get('Timing', {}))
+        for record in run_records
+        if 'File Path' in record and unchanged_image(record=record)}
+
+
+def start_worker_pool(workers,
+                      trace_memory='False'):
+    '''
+    Start a pool of worker processes to analyse images on.
+    Args:
+        workers: <int> number of worker processes
+        trace_memory: <string> "True" or "False", trace memory allocations in
+                        the workers so stage timings include peak memory (see
+                        instrument.start_memory_tracing)
+    Returns:
+        worker_pool: <dict> "Executor": ProcessPoolExecutor, "Workers": number
+                        of worker processes and "Initializer": worker process
+                        initializer, None if workers is 1 or less (images are
+                        analysed in this process)
+    '''
+    if workers <= 1:
+        return None
+    worker_pool = {
+        'Workers': workers,
+        'Initializer': (
+            instrument.start_memory_tracing if trace_memory == 'True'
+            else None)}
+    worker_pool['Executor'] = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=worker_pool['Initializer'])
+    return worker_pool
+
+
+def restart_worker_pool(worker_pool):
+    '''
+    Replace a broken worker pool (a worker process died, e.g. killed when out
+    of memory) with a new one, so the run carries on.
+    Args:
+        worker_pool: <dict> worker pool from start_worker_pool, updated in
+                        place
+    Returns:
+        None
+    '''
+    worker_pool['Executor'].shutdown(wait=True)
+    worker_pool['Executor'] = ProcessPoolExecutor(
+        max_workers=worker_pool['Workers'],
+        initializer=worker_pool['Initializer'])
+
+
+def submit_image(worker_pool,
+                 file_path,
+                 prefetched,
+                 profile_paths,
+                 image_arguments):
+    '''
+    Submit an image analysis to the worker pool.
+    Args:
+        worker_pool: <dict> worker pool from start_worker_pool
+        file_path: <string> path to image file
+        prefetched: <tuple> as yielded by prefetch_image_inputs
+        profile_paths: <dict> file path string: cProfile output path
+        image_arguments: <dict> remaining isolated_image_grating_frequency
+                            arguments
+    Returns:
+        future: <Future> isolated_image_grating_frequency call
+    '''
+    return worker_pool['Executor'].submit(
+        isolated_image_grating_frequency,
+        file_path=file_path,
+        profile_path=profile_paths.get(f'{file_path}'),
+        prefetched=prefetched,
+        **image_arguments)
+
+
+def future_results(file_path,
+                   future):
+    '''
+    Results of an image analysis run on a process pool, recording an error if
+    the analysis could not be run.
+    Args:
+        file_path: <string> path to image file
+        future: <Future> finished isolated_image_grating_frequency call
+    Returns:
+        image_results: <tuple> (image_dictionary, period_dictionary,
+                        timing_dictionary) as isolated_image_grating_frequency
+    '''
+    try:
+        return future.result()
+    except Exception as error:
+        return image_error(file_path=file_path, error=error), {}, {}
+
+
+def broken_future(future):
+    '''
+    Check whether a finished image analysis was lost to a broken worker pool.
+    Args:
+        future: <Future> finished isolated_image_grating_frequency call
+    Returns:
+        broken: <bool> True if the worker pool broke before the image finished
+    '''
+    return isinstance(future.exception(), BrokenProcessPool)
+
+
+def rerun_broken_images(worker_pool,
+                        futures,
+                        profile_paths,
+                        image_arguments):
+    '''
+    Recover from a worker process dying. When a worker dies, every image in
+    flight on the pool fails with BrokenProcessPool, whichever image killed
+    it. Images that finished before the pool broke are kept, the pool is
+    restarted, and the lost images are analysed again one at a time: an image
+    that kills its worker again is recorded as failed (and the pool restarted
+    again), the others are analysed as normal.
+    Args:
+        worker_pool: <dict> worker pool from start_worker_pool, restarted in
+                        place
+        futures: <dict> future: (file path, prefetched) of every image
+                    submitted and not yet collected
+        profile_paths: <dict> file path string: cProfile output path
+        image_arguments: <dict> remaining isolated_image_grating_frequency
+                            arguments
+    Returns:
+        finished_files: <generator> (file path, image results) for every
+                        image in futures
+    '''
+    wait(futures)
+    broken_files = []
+    for future, (file, prefetched) in futures.items():
+        if broken_future(future=future):
+            broken_files.append((file, prefetched))
+        else:
+            yield file, future_results(file_path=file, future=future)
+    restart_worker_pool(worker_pool=worker_pool)
+    for file, prefetched in broken_files:
+        future = submit_image(
+            worker_pool=worker_pool,
+            file_path=file,
+            prefetched=prefetched,
+            profile_paths=profile_paths,
+            image_arguments=image_arguments)
+        wait([future])
+        if broken_future(future=future):
+            restart_worker_pool(worker_pool=worker_pool)
+        yield file, future_results(file_path=file, future=future)
+
+
+def bounded_executor_results(worker_pool,
+                             prefetched_files,
+                             prefetch,
+                             profile_paths,
+                             image_arguments):
+    '''
+    Analyse prefetched images on a process pool, keeping at most prefetch
+    images submitted but unfinished so read images do not pile up in memory.
+    If a worker process dies, the pool is restarted and only the image that
+    killed it is recorded as failed (see rerun_broken_images), instead of
+    aborting the batch.
+    Args:
+        worker_pool: <dict> worker pool from start_worker_pool, restarted in
+                        place if it breaks
+        prefetched_files: <generator> as prefetch_image_inputs
+        prefetch: <int> maximum number of images submitted at once
+        profile_paths: <dict> file path string: cProfile output path
+        image_arguments: <dict> remaining isolated_image_grating_frequency
+                            arguments
+    Returns:
+        finished_files: <generator> (file path, image results) as each image
+                        finishes, see future_results
+    '''
+    futures = {}
+    for file, prefetched in prefetched_files:
+        try:
+            future = submit_image(
+                worker_pool=worker_pool,
+                file_path=file,
+                prefetched=prefetched,
+                profile_paths=profile_paths,
+                image_arguments=image_arguments)
+        except BrokenProcessPool:
+            yield from rerun_broken_images(
+                worker_pool=worker_pool,
+                futures=futures,
+                profile_paths=profile_paths,
+                image_arguments=image_arguments)
+            futures = {}
+            future = submit_image(
+                worker_pool=worker_pool,
+                file_path=file,
+                prefetched=prefetched,
+                profile_paths=profile_paths,
+                image_arguments=image_arguments)
+        futures[future] = (file, prefetched)
+        if len(futures) < prefetch:
+            continue
+        finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+        if any(broken_future(future=future) for future in finished):
+            yield from rerun_broken_images(
+                worker_pool=worker_pool,
+                futures=futures,
+                profile_paths=profile_paths,
+                image_arguments=image_arguments)
+            futures = {}
+            continue
+        for future in finished:
+            file, _ = futures.pop(future)
+            yield file, future_results(file_path=file, future=future)
+    for future in as_completed(list(futures)):
+        if broken_future(future=future):
+            yield from rerun_broken_images(
+                worker_pool=worker_pool,
+                futures=futures,
+                profile_paths=profile_paths,
+                image_arguments=image_arguments)
+            return
+        file, _ = futures.pop(future)
+        yield file, future_results(file_path=file, future=future)
 
 
 def batch_grating_frequency(parent_directory,
                             batch_name,
                             file_paths,
                             directory_paths,
-                            plot_files):
+                            plot_files,
+                            worker_pool=None,
+                            log_index=None,
+                            cache_size=1E9,
+                            spectrum_mode='Rows',
+                            fill_factor='False',
+                            plot_dpi=600,
+                            plot_methods='All',
+                            stream_path=None,
+                            resume=True,
+                            timing_path=None,
+                            profile_image=None,
+                            prefetch=4,
+                            stage_size=1E10,
+                            shard_paths=None):
     '''
     Calculate sample batch grating frequency and period for optimised data
-    thresholding.
+    thresholding. Images are analysed in parallel if a worker pool is given,
+    results are collected in file path order either way. Only this batch's
+    image results are kept, so memory does not grow with the number of
+    batches in a run. If a stream path is given,
+    results are also streamed to a newline delimited json file: a batch
+    record, then one record per image as soon as it is analysed, then a
+    summary record with the batch averages (see rebuild_batch_dictionary).
+    The stream doubles as a checkpoint: if resume is True and the stream was
+    left by an earlier run of the same batch with the same settings, images
+    it records are not analysed again and the run carries on appending to it.
+    If a timing path is given, the per-stage timings of each image and their
+    batch aggregate are saved there (see src.instrument). Images and logs are
+    read on background threads ahead of the analysis (prefetch_image_inputs).
+    With a worker pool, at most prefetch images are submitted but unfinished,
+    so prefetch should be more than the number of worker processes.
     Args:
         parent_directory: <string> parent directory identifier
         batch_name: <string> batch name string
         file_paths: <array> array of target file paths
         directory_paths: <dict> dictionary containing required paths
         plot_files: <string> "True" or "False" for plotting output
+        worker_pool: <dict> worker pool from start_worker_pool to analyse
+                        images on, None analyses images one at a time in this
+                        process
+        log_index: <dict> SEM log index from fp.build_log_index, built here if
+                    None
+        cache_size: <int> maximum result cache size in bytes, the cache (and
+                    staging directory) is evicted once the batch's images are
+                    analysed, see evict_directories
+        spectrum_mode: <string> "Rows" or "Averaged" (fast mode) spectrum
+                        analysis, see anal.multi_threshold_grating_frequency
+        fill_factor: <string> "True" or "False" for fill factor analysis
+        plot_dpi: <int> plot resolution in dots per inch
+        plot_methods: <string> "All" or "Selected" thresholding methods to plot
+        stream_path: <string> path to results stream file, None does not
+                        stream results
+        resume: <bool> if True, carry on from a matching results stream,
+                otherwise the stream is overwritten
+        timing_path: <string> path to save stage timings json, None does not
+                        save timings
+        profile_image: <string> file name (without extension) of an image to
+                        run under cProfile, its profile is saved as
+                        "{file name}.prof" in the results directory
+        prefetch: <int> maximum number of images read ahead of the analysis,
+                    and with a worker pool, the maximum number of images
+                    submitted to it at once
+        stage_size: <int> maximum staging directory size in bytes, used if
+                    directory_paths has a "Stage Path"
+        shard_paths: <array> subset of file paths to analyse when the batch
+                        is split between nodes, the stream, timings and
+                        averages then only cover these images (see
+                        merge_shard_streams), None analyses every file
     Returns:
+        batch_dictionary: <dict> batch, image, log, and results entries with
+                            the batch average grating periods
     '''
     batch_dictionary = fp.update_batch_dictionary(
         parent=parent_directory,
         batch_name=batch_name,
         file_paths=file_paths)
-    period_dictionary = {}
-    for file in file_paths:
-        sample_image = io.read_image(file_path=file)
-        sample_parameters = fp.sample_information(file_path=file)
-        log_path, log_parameters = fp.find_semlog(
+    if log_index is None:
+        log_index = fp.build_log_index(
             log_path=directory_paths['SEM Path'],
-            sample_details=sample_parameters,
             file_string='.txt')
-        if len(log_path) == 0:
-            pass
-        else:
-            image_parameters = io.read_SEM_log(file_path=log_path[0])
-            grating_region = anal.trim_img_to_roi(
-                image=sample_image,
-                height=image_parameters['image_height'],
-                width=image_parameters['image_width'])
-            distanceperpixel = anal.calc_distance_per_pixel(
-                distance_value=image_parameters['calibration_distance'],
-                distance_unit=image_parameters['distance_unit'],
-                number_of_pixels=image_parameters['calibration_pixels'])
-            out_string = sample_parameters[f'{parent} Secondary String']
-            results_dictionary = anal.calculate_grating_frequency(
-                grating_region=grating_region,
-                distance_per_pixel=distanceperpixel,
-                sample_name=out_string,
-                design_period=int(sample_parameters[f'{parent} Design Period']),
-                plot_files=plot_files,
-                out_path=Path(
-                    f'{directory_paths["Results Path"]}'
-                    f'/{batch}_{out_string}'))
-            batch_dictionary.update({f'{out_string} Image': sample_parameters})
-            batch_dictionary.update({f'{out_string} Log File': log_parameters})
-            batch_dictionary.update({f'{out_string} Log': image_parameters})
-            batch_dictionary.update(results_dictionary)
-            period_dictionary.update({
-                f'{out_string}':
-                results_dictionary[f'{out_string} Grating Period']})
-    print(period_dictionary)
+    '''
+    Images and logs are read (and logs looked up in the index) by the
+    prefetching threads in this process, so the log index is not sent to the
+    worker processes with every image.
+    '''
+    image_arguments = {
+        'parent_directory': parent_directory,
+        'batch_name': batch_name,
+        'directory_paths': directory_paths,
+        'plot_files': plot_files,
+        'spectrum_mode': spectrum_mode,
+        'fill_factor': fill_factor,
+        'plot_dpi': plot_dpi,
+        'plot_methods': plot_methods}
+    batch_images = {}
+    analysed_paths = file_paths if shard_paths is None else shard_paths
+    if stream_path is not None:
+        batch_record = batch_stream_record(
+            batch_dictionary=batch_dictionary,
+            file_paths=file_paths,
+            plot_files=plot_files,
+            spectrum_mode=spectrum_mode,
+            fill_factor=fill_factor,
+            shard_paths=shard_paths)
+        finished_images = None
+        if resume:
+            finished_images = load_checkpoint(
+                stream_path=stream_path,
+                batch_record=batch_record)
+        if finished_images is None:
+            finished_images = {}
+            io.save_json_records(
+                out_path=stream_path,
+                records=[batch_record])
+        batch_images.update(finished_images)
+    new_files = [
+        file for file in analysed_paths if f'{file}' not in batch_images]
+    profile_paths = {
+        f'{file}': Path(
+            f'{directory_paths["Results Path"]}'
+            f'/{fp.get_filename(file_path=file)}.prof')
+        for file in new_files
+        if fp.get_filename(file_path=file) == profile_image}
+    prefetched_files = prefetch_image_inputs(
+        file_paths=new_files,
+        prefetch=prefetch,
+        parent_directory=parent_directory,
+        directory_paths=directory_paths,
+        log_index=log_index)
+    if worker_pool is None:
+        finished_files = (
+            (file, isolated_image_grating_frequency(
+                file_path=file,
+                profile_path=profile_paths.get(f'{file}'),
+                prefetched=prefetched,
+                **image_arguments))
+            for file, prefetched in prefetched_files)
+    else:
+        finished_files = bounded_executor_results(
+            worker_pool=worker_pool,
+            prefetched_files=prefetched_files,
+            prefetch=prefetch,
+            profile_paths=profile_paths,
+            image_arguments=image_arguments)
+    for file, image_results in finished_files:
+        batch_images[f'{file}'] = image_results
+        if stream_path is not None:
+            io.append_json_record(
+                out_path=stream_path,
+                record=image_record(
+                    file_path=file,
+                    image_results=image_results))
+    evict_directories(
+        directory_paths=directory_paths,
+        cache_size=cache_size,
+        stage_size=stage_size)
+    period_dictionary = {}
+    image_timings = {}
+    for file in analysed_paths:
+        image_dictionary, image_periods, timings = batch_images[f'{file}']
+        batch_dictionary.update(image_dictionary)
+        period_dictionary.update(image_periods)
+        image_timings[fp.get_filename(file_path=file)] = timings
     average_dictionary = anal.average_grating_period(
         period_dictionary=period_dictionary)
     batch_dictionary.update(average_dictionary)
+    if stream_path is not None:
+        io.append_json_record(
+            out_path=stream_path,
+            record={'Summary': average_dictionary})
+    if timing_path is not None:
+        io.save_json_dicts(
+            out_path=timing_path,
+            dictionary={
+                'Images': image_timings,
+                'Batch': instrument.aggregate_timings(
+                    image_timings=image_timings)})
     return batch_dictionary
 
 
+def merge_shard_streams(stream_paths,
+                        batch_record):
+    '''
+    Combine the results streams written by the nodes of a sharded run into
+    the stream a single node would have written for the batch: the batch
+    record, every image record in file path order, and a summary record with
+    the batch averages. Only shard streams written for this batch record
+    (same files, settings and analysis code) are used, from their last batch
+    record, and a later stream's record for an image replaces an earlier one.
+    Args:
+        stream_paths: <array> paths to the batch's shard results streams
+        batch_record: <dict> expected batch record, see batch_stream_record
+    Returns:
+        records: <array> merged results stream records, None if any image is
+                    missing from the shards
+        missing_paths: <array> file path strings missing from the shards
+    '''
+    batch_record = json.loads(json.dumps(batch_record, default=io.convert))
+    image_records = {}
+    for stream_path in sorted(stream_paths):
+        records = io.load_json_records(file_path=stream_path)
+        batch_records = [
+            index for index, record in enumerate(records) if 'Batch' in record]
+        if len(batch_records) == 0:
+            continue
+        shard_record = dict(records[batch_records[-1]])
+        shard_record.pop('Shard Paths', None)
+        if shard_record != batch_record:
+            continue
+        image_records.update({
+            record['File Path']: record
+            for record in records[batch_records[-1]:]
+            if 'File Path' in record})
+    missing_paths = [
+        file for file in batch_record['File Paths']
+        if file not in image_records]
+    if len(missing_paths) > 0:
+        return None, missing_paths
+    period_dictionary = {}
+    for file in batch_record['File Paths']:
+        period_dictionary.update(image_records[file]['Periods'])
+    average_dictionary = anal.average_grating_period(
+        period_dictionary=period_dictionary)
+    records = (
+        [batch_record]
+        + [image_records[file] for file in batch_record['File Paths']]
+        + [{'Summary': average_dictionary}])
+    return records, missing_paths
+
+
 if __name__ == '__main__':
 
     ''' Organisation '''
@@ -78,21 +981,138 @@ if __name__ == '__main__':
         directory_path=directory_paths["SEM Path"],
         file_string='.bmp')
     parent, batches = fp.get_all_batches(file_paths=file_paths)
+    log_index = fp.build_log_index(
+        log_path=directory_paths['SEM Path'],
+        file_string='.txt')
+
+    '''
+    Sharding, "Shard Count" and "Shard Index" (and "Shard By", "Batch" or
+    "Image") or a "Shard Manifest Path" json in info.json split the batches
+    between nodes sharing the results directory. Each node streams its part of
+    each batch to "Shard Path" (default "{Results Path}/Shards"), then
+    merge_SEM_shards.py writes the batch results.
+    '''
+    sharded = 'Shard Count' in info or 'Shard Manifest Path' in directory_paths
+    if sharded:
+        if 'Shard Manifest Path' in directory_paths:
+            manifest_path = directory_paths['Shard Manifest Path']
+            manifest = io.load_json(file_path=manifest_path)
+            shard_name = fp.get_filename(file_path=manifest_path)
+        else:
+            manifest = None
+            shard_name = f'{info["Shard Index"]}of{info["Shard Count"]}'
+        shard = fp.shard_batches(
+            batches=batches,
+            shard_index=int(info.get('Shard Index', 0)),
+            shard_count=int(info.get('Shard Count', 1)),
+            shard_by=info.get('Shard By', 'Batch'),
+            manifest=manifest)
+        shard_path = directory_paths.get(
+            'Shard Path',
+            Path(f'{directory_paths["Results Path"]}/Shards'))
+        os.makedirs(shard_path, exist_ok=True)
+
+    '''
+    Local Staging, "Stage Path" and "Stage Size" (MB) in info.json. Every image
+    and log in the SEM directory is staged in one pass before analysis, later
+    runs only copy new or changed files. Sharded runs only stage their own
+    files, as they are read.
+    '''
+    stage_size = float(info.get('Stage Size', 10000)) * 1E6
+    if 'Stage Path' in directory_paths and not sharded:
+        staging.stage_directory(
+            stage_path=directory_paths['Stage Path'],
+            directory_path=directory_paths['SEM Path'],
+            file_strings=['.bmp', '.txt'],
+            stage_size=stage_size)
+
+    '''
+    Worker Processes, "Workers" in info.json, defaults to all cores. "Trace
+    Memory" "True" adds each stage's peak memory to the timings, at about 25%
+    more analysis time
+    '''
+    workers = int(info.get('Workers', os.cpu_count()))
+    trace_memory = info.get('Trace Memory', 'False')
+    if trace_memory == 'True':
+        instrument.start_memory_tracing()
+    worker_pool = start_worker_pool(
+        workers=workers,
+        trace_memory=trace_memory)
+
+    '''
+    Result Cache, "Cache Path" and "Cache Size" (MB) in info.json. With a cache,
+    batches with existing results are rerun, unchanged images are cache hits.
+    '''
+    use_cache = 'Cache Path' in directory_paths
+    cache_size = float(info.get('Cache Size', 1000)) * 1E6
+
+    '''
+    Stage timings are saved to "{batch}_Timing.json". "Profile Image" in
+    info.json names an image (file name without extension) to run under
+    cProfile
+    '''
+    profile_image = info.get('Profile Image')
+
+    '''
+    Images read ahead of the analysis, "Prefetch" in info.json (default 4), on
+    top of one image per worker process
+    '''
+    prefetch = int(info.get('Prefetch', 4))
+    if worker_pool is not None:
+        prefetch += workers
 
     ''' Batch Processing '''
     for batch, filepaths in batches.items():
         out_file = Path(
             f'{directory_paths["Results Path"]}'
             f'/{batch}_Period.json')
-        if out_file.is_file():
-            pass
-        else:
-            results_dictionary = batch_grating_frequency(
-                parent_directory=parent,
-                batch_name=batch,
-                file_paths=file_paths,
-                directory_paths=directory_paths,
-                plot_files=info['Plot Files'])
-            io.save_json_dicts(
-                out_path=out_file,
-                dictionary=results_dictionary)
+        stream_file = Path(
+            f'{directory_paths["Results Path"]}'
+            f'/{batch}_Period.ndjson')
+        timing_file = Path(
+            f'{directory_paths["Results Path"]}'
+            f'/{batch}_Timing.json')
+        shard_paths = None
+        if sharded:
+            if batch not in shard:
+                continue
+            shard_paths = shard[batch]
+            stream_file = Path(
+                f'{shard_path}'
+                f'/{batch}_Period.{shard_name}.ndjson')
+            timing_file = None
+        elif out_file.is_file() and not use_cache:
+            continue
+        batch_grating_frequency(
+            parent_directory=parent,
+            batch_name=batch,
+            file_paths=filepaths,
+            directory_paths=directory_paths,
+            plot_files=info['Plot Files'],
+            worker_pool=worker_pool,
+            log_index=log_index,
+            cache_size=cache_size,
+            spectrum_mode=info.get('Spectrum Mode', 'Rows'),
+            fill_factor=info.get('Fill Factor', 'False'),
+            plot_dpi=int(info.get('Plot DPI', 600)),
+            plot_methods=info.get('Plot Methods', 'All'),
+            stream_path=stream_file,
+            timing_path=timing_file,
+            profile_image=profile_image,
+            prefetch=prefetch,
+            stage_size=stage_size,
+            shard_paths=shard_paths)
+        if sharded:
+            continue
+        results_dictionary = rebuild_batch_dictionary(
+            records=io.load_json_records(file_path=stream_file))
+        io.save_json_dicts(
+            out_path=out_file,
+            dictionary=results_dictionary)
+        if 'Store Path' in directory_paths:
+            store.store_batch_results(
+                store_path=directory_paths['Store Path'],
+                batch_dictionary=results_dictionary)
+    if worker_pool is not None:
+        worker_pool['Executor'].shutdown()
+    plot.wait_for_plots()
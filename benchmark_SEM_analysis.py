@@ -0,0 +1,350 @@
+import time
+import tempfile
+import argparse
+import numpy as np
+import src.fileIO as io
+import src.analysis as anal
+import src.plotting as plot
+import src.synthetic as syn
+
+from pathlib import Path
+from batch_SEM_analysis import batch_grating_frequency
+
+
+''' Analysis options compared for speed and accuracy: options '''
+analysis_options = {
+    'FFT Rows': {},
+    'FFT Averaged': {'spectrum_mode': 'Averaged'},
+    'Zoom': {'period_estimator': 'Zoom'}}
+
+
+def best_time(function,
+              repeats,
+              **kwargs):
+    '''
+    Best wall time of repeated calls to a function.
+    Args:
+        function: <function> function to time
+        repeats: <int> number of calls
+        kwargs: function arguments
+    Returns:
+        seconds: <float> shortest call time in seconds
+        result: function return value from the last call
+    '''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(**kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def write_samples(directory_path,
+                  batch_name,
+                  number_of_images,
+                  height,
+                  width,
+                  seed):
+    '''
+    Write a batch of synthetic grating samples with random periods, fill
+    factors, noise, tilt and scum.
+    Args:
+        directory_path: <string> path to SEM directory
+        batch_name: <string> primary string of the samples
+        number_of_images: <int> number of samples
+        height: <int> image height in pixels
+        width: <int> image width in pixels
+        seed: <int> random number generator seed
+    Returns:
+        samples: <dict> file name: ground truth dictionary
+    '''
+    rng = np.random.default_rng(seed)
+    samples = {}
+    for index in range(number_of_images):
+        design_period = int(rng.choice([250, 300, 400, 500]))
+        file_name = f'{batch_name}_P{design_period}_G{index}'
+        samples[file_name] = syn.write_synthetic_sample(
+            directory_path=directory_path,
+            file_name=file_name,
+            height=height,
+            width=width,
+            period=design_period * rng.uniform(0.97, 1.03),
+            fill_factor=rng.uniform(0.3, 0.7),
+            noise=rng.uniform(10, 40),
+            tilt=rng.uniform(-0.5, 0.5),
+            scum=int(rng.integers(0, 3)),
+            seed=int(rng.integers(2 ** 31)))
+    return samples
+
+
+def benchmark_image(directory_path,
+                    file_name,
+                    ground_truth,
+                    results_path,
+                    repeats):
+    '''
+    Time each analysis stage for one synthetic sample and measure the accuracy
+    of each analysis option against the ground truth.
+    Args:
+        directory_path: <string> path to SEM directory
+        file_name: <string> sample file name without extension
+        ground_truth: <dict> as returned by syn.write_synthetic_sample
+        results_path: <string> path to save plots and json output
+        repeats: <int> number of times each stage is timed
+    Returns:
+        stage_times: <dict> stage: best time in seconds
+        accuracy: <dict> analysis option: (time in seconds, period error in
+                    nm, fill factor error)
+    '''
+    stage_times = {}
+    stage_times['Log Parse'], parameters = best_time(
+        io.read_SEM_log,
+        repeats,
+        file_path=Path(f'{directory_path}/{file_name}.txt'))
+    stage_times['Image Load'], grating = best_time(
+        io.read_image_region,
+        repeats,
+        file_path=Path(f'{directory_path}/{file_name}.bmp'),
+        height=parameters['image_height'],
+        width=parameters['image_width'])
+    distance_per_pixel = anal.calc_distance_per_pixel(
+        distance_value=parameters['calibration_distance'],
+        distance_unit=parameters['distance_unit'],
+        number_of_pixels=parameters['calibration_pixels'])
+    design_period = int(file_name.split('_')[1][1:])
+    thresholds = ['Mean', 'Mean-StdDev', 'Mean+StdDev', 'None']
+    stage_times['Threshold'], binary_regions = best_time(
+        anal.threshold_regions,
+        repeats,
+        region=grating,
+        thresholds=thresholds)
+    stage_times['FFT'], (sample_size, freq_coords, abs_intensities) = (
+        best_time(
+            anal.calc_region_freqs,
+            repeats,
+            region=np.concatenate(list(binary_regions.values()))))
+    stage_times['Peak Finding'], _ = best_time(
+        anal.region_fftsignalprocessing,
+        repeats,
+        frequency_coordinates=freq_coords,
+        absolute_intensities=abs_intensities,
+        micrometers_per_pixel=distance_per_pixel,
+        sample_size=sample_size,
+        number_of_frequencies=5)
+    diagnostics = {}
+    anal.multi_threshold_grating_frequency(
+        grating=grating,
+        distance_per_pixel=distance_per_pixel,
+        thresholds=['Mean'],
+        sample_name=file_name,
+        plot_files='False',
+        out_path='',
+        diagnostics=diagnostics)
+
+    def plot_and_save():
+        anal.plot_grating_fft(
+            *diagnostics['Mean'],
+            out_path=Path(f'{results_path}/{file_name}'))
+        plot.wait_for_plots()
+
+    stage_times['Plotting'], _ = best_time(plot_and_save, repeats)
+
+    accuracy = {}
+    for option, kwargs in analysis_options.items():
+        option_time, results = best_time(
+            anal.calculate_grating_frequency,
+            repeats,
+            grating_region=grating,
+            distance_per_pixel=distance_per_pixel,
+            sample_name=file_name,
+            design_period=design_period,
+            plot_files='False',
+            out_path='',
+            **kwargs)
+        fill_factor = anal.grating_fill_factor(
+            grating=grating,
+            distance_per_pixel=distance_per_pixel,
+            grating_period=results[f'{file_name} Grating Period'],
+            sample_name=file_name)
+        accuracy[option] = (
+            option_time,
+            results[f'{file_name} Grating Period'] - ground_truth['period'],
+            fill_factor[f'{file_name} Fill Factor']
+            - ground_truth['fill_factor'])
+        if option == 'FFT Rows':
+            stage_times['Analysis'] = option_time
+            results.update(fill_factor)
+            stage_times['JSON Write'], _ = best_time(
+                io.save_json_dicts,
+                repeats,
+                out_path=Path(f'{results_path}/{file_name}.json'),
+                dictionary=results)
+    return stage_times, accuracy
+
+
+def benchmark_sizes(root_path,
+                    sizes,
+                    images_per_size,
+                    repeats):
+    '''
+    Stage times and accuracy across image sizes, averaged over several
+    synthetic samples per size.
+    Args:
+        root_path: <string> path to a scratch directory
+        sizes: <array> (height, width) image sizes
+        images_per_size: <int> number of samples per size
+        repeats: <int> number of times each stage is timed
+    Returns:
+        results: <dict> "height x width": stage times and accuracy
+    '''
+    results = {}
+    for height, width in sizes:
+        directory_path = Path(f'{root_path}/Sizes/{height}x{width}/SEM')
+        results_path = Path(f'{root_path}/Sizes/{height}x{width}/Results')
+        results_path.mkdir(parents=True, exist_ok=True)
+        samples = write_samples(
+            directory_path=directory_path,
+            batch_name='S',
+            number_of_images=images_per_size,
+            height=height,
+            width=width,
+            seed=height)
+        stage_times = []
+        accuracies = []
+        for file_name, ground_truth in samples.items():
+            times, accuracy = benchmark_image(
+                directory_path=directory_path,
+                file_name=file_name,
+                ground_truth=ground_truth,
+                results_path=results_path,
+                repeats=repeats)
+            stage_times.append(times)
+            accuracies.append(accuracy)
+        results[f'{height}x{width}'] = {
+            'Stage Times': {
+                stage: np.mean([times[stage] for times in stage_times])
+                for stage in stage_times[0]},
+            'Options': {
+                option: {
+                    'Time': np.mean([a[option][0] for a in accuracies]),
+                    'Period RMS Error': np.sqrt(
+                        np.mean([a[option][1] ** 2 for a in accuracies])),
+                    'Fill Factor RMS Error': np.sqrt(
+                        np.mean([a[option][2] ** 2 for a in accuracies]))}
+                for option in analysis_options}}
+    return results
+
+
+def benchmark_batches(root_path,
+                      batch_sizes,
+                      height,
+                      width):
+    '''
+    End to end batch_grating_frequency time across batch sizes, analysing
+    images one at a time in this process.
+    Args:
+        root_path: <string> path to a scratch directory
+        batch_sizes: <array> number of images per batch
+        height: <int> image height in pixels
+        width: <int> image width in pixels
+    Returns:
+        results: <dict> batch size: total and per image time in seconds
+    '''
+    results = {}
+    for batch_size in batch_sizes:
+        directory_path = Path(f'{root_path}/Batches/{batch_size}/SEM')
+        results_path = Path(f'{root_path}/Batches/{batch_size}/Results')
+        results_path.mkdir(parents=True, exist_ok=True)
+        samples = write_samples(
+            directory_path=directory_path,
+            batch_name=f'B{batch_size}',
+            number_of_images=batch_size,
+            height=height,
+            width=width,
+            seed=batch_size)
+        start = time.perf_counter()
+        batch_grating_frequency(
+            parent_directory='SEM',
+            batch_name=f'B{batch_size}',
+            file_paths=[
+                Path(f'{directory_path}/{file_name}.bmp')
+                for file_name in samples],
+            directory_paths={
+                'SEM Path': directory_path,
+                'Results Path': results_path},
+            plot_files='False')
+        batch_time = time.perf_counter() - start
+        results[f'{batch_size}'] = {
+            'Time': batch_time,
+            'Time Per Image': batch_time / batch_size}
+    return results
+
+
+def print_report(size_results,
+                 batch_results):
+    '''
+    Print benchmark tables.
+    Args:
+        size_results: <dict> as returned by benchmark_sizes
+        batch_results: <dict> as returned by benchmark_batches
+    Returns:
+        None
+    '''
+    for size, results in size_results.items():
+        print(f'\n{size} stage times [ms]')
+        for stage, seconds in results['Stage Times'].items():
+            print(f'  {stage:<14}{seconds * 1E3:10.1f}')
+        print(f'{size} analysis options [ms, nm RMS, fill factor RMS]')
+        for option, option_results in results['Options'].items():
+            print(
+                f'  {option:<20}{option_results["Time"] * 1E3:10.1f}'
+                f'{option_results["Period RMS Error"]:10.3f}'
+                f'{option_results["Fill Factor RMS Error"]:10.4f}')
+    print('\nbatch size: total [s], per image [ms]')
+    for batch_size, results in batch_results.items():
+        print(
+            f'  {batch_size:<6}{results["Time"]:10.2f}'
+            f'{results["Time Per Image"] * 1E3:10.1f}')
+
+
+if __name__ == '__main__':
+
+    ''' Options '''
+    parser = argparse.ArgumentParser(
+        description='Benchmark the SEM analysis on synthetic gratings.')
+    parser.add_argument(
+        '--sizes',
+        nargs='+',
+        default=['480x640', '960x1280', '1920x2560'],
+        help='image sizes as heightxwidth')
+    parser.add_argument('--images', type=int, default=4)
+    parser.add_argument(
+        '--batch-sizes',
+        nargs='+',
+        type=int,
+        default=[1, 4, 16])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--out', default='benchmark.json')
+    arguments = parser.parse_args()
+    sizes = [
+        tuple(int(pixels) for pixels in size.split('x'))
+        for size in arguments.sizes]
+
+    ''' Benchmark '''
+    with tempfile.TemporaryDirectory() as root_path:
+        size_results = benchmark_sizes(
+            root_path=root_path,
+            sizes=sizes,
+            images_per_size=arguments.images,
+            repeats=arguments.repeats)
+        batch_results = benchmark_batches(
+            root_path=root_path,
+            batch_sizes=arguments.batch_sizes,
+            height=sizes[0][0],
+            width=sizes[0][1])
+    print_report(
+        size_results=size_results,
+        batch_results=batch_results)
+    io.save_json_dicts(
+        out_path=arguments.out,
+        dictionary={'Sizes': size_results, 'Batches': batch_results})
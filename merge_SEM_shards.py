@@ -0,0 +1,89 @@
+import src.fileIO as io
+import src.filepaths as fp
+import src.store as store
+import src.instrument as instrument
+
+from pathlib import Path
+from batch_SEM_analysis import (
+    batch_stream_record,
+    merge_shard_streams,
+    rebuild_batch_dictionary)
+
+
+def save_merged_batch(records,
+                      results_path,
+                      batch_name,
+                      store_path=None):
+    '''
+    Save a merged batch the way a single node run does: the results stream,
+    the "_Period.json" results dictionary, the stage timings, and the results
+    store if one is set.
+    Args:
+        records: <array> merged results stream records, see
+                    merge_shard_streams
+        results_path: <string> path to results directory
+        batch_name: <string> batch name string
+        store_path: <string> path to SQLite results store, None does not
+                    store results
+    Returns:
+        None
+    '''
+    io.save_json_records(
+        out_path=Path(f'{results_path}/{batch_name}_Period.ndjson'),
+        records=records)
+    results_dictionary = rebuild_batch_dictionary(records=records)
+    io.save_json_dicts(
+        out_path=Path(f'{results_path}/{batch_name}_Period.json'),
+        dictionary=results_dictionary)
+    image_timings = {
+        fp.get_filename(file_path=record['File Path']): record['Timing']
+        for record in records
+        if 'File Path' in record}
+    io.save_json_dicts(
+        out_path=Path(f'{results_path}/{batch_name}_Timing.json'),
+        dictionary={
+            'Images': image_timings,
+            'Batch': instrument.aggregate_timings(
+                image_timings=image_timings)})
+    if store_path is not None:
+        store.store_batch_results(
+            store_path=store_path,
+            batch_dictionary=results_dictionary)
+
+
+if __name__ == '__main__':
+
+    ''' Organisation '''
+    root = Path().absolute()
+    info, directory_paths = fp.get_directory_paths(root_path=root)
+    file_paths = fp.get_files_paths(
+        directory_path=directory_paths["SEM Path"],
+        file_string='.bmp')
+    parent, batches = fp.get_all_batches(file_paths=file_paths)
+    shard_path = directory_paths.get(
+        'Shard Path',
+        Path(f'{directory_paths["Results Path"]}/Shards'))
+
+    ''' Merge every batch whose images have all been analysed by the shards '''
+    for batch, filepaths in batches.items():
+        batch_record = batch_stream_record(
+            batch_dictionary=fp.update_batch_dictionary(
+                parent=parent,
+                batch_name=batch,
+                file_paths=filepaths),
+            file_paths=filepaths,
+            plot_files=info['Plot Files'],
+            spectrum_mode=info.get('Spectrum Mode', 'Rows'),
+            fill_factor=info.get('Fill Factor', 'False'))
+        records, missing_paths = merge_shard_streams(
+            stream_paths=Path(shard_path).glob(f'{batch}_Period.*.ndjson'),
+            batch_record=batch_record)
+        if records is None:
+            print(f'{batch}: {len(missing_paths)} images not analysed yet')
+            continue
+        save_merged_batch(
+            records=records,
+            results_path=directory_paths['Results Path'],
+            batch_name=batch,
+            store_path=directory_paths.get('Store Path'))
+        print(f'{batch}: merged')
@@ -1,8 +1,7 @@
 import numpy as np
-import scipy.signal as sig
 
 from pathlib import Path
-from src.plotting import multi_xsys_plot, multiy_plot
+from src.plotting import multi_xsys_plot, multiy_plot, submit_plot
 
 
 def mean_array(x):
@@ -106,14 +105,9 @@ def pixel_threshold(raw_row,
         raw_row: <array> pixel values for image row
         threshold: <float/int> pixel value for thresholding
     Returns:
-        binary_row: <array> binary row pixel data
+        binary_row: <array> uint8 binary row pixel data
     '''
-    binary_row = []
-    for pixel in raw_row:
-        if pixel < threshold:
-            binary_row.append(0)
-        if pixel >= threshold:
-            binary_row.append(255)
+    binary_row = (np.asarray(raw_row) >= threshold).astype(np.uint8) * 255
     return binary_row
 
 
@@ -141,6 +135,8 @@ def row_fftsignalprocessing(frequency_coordinates,
                             number_of_frequencies):
     '''
     Process fourier transform of image row to find periods and frequencies.
+    Peaks are taken in order of decreasing prominence, equal prominences in
+    order of increasing frequency.
     Args:
         frequency_coordinates: <array> frequency space x-axis array
         absolute_intensity: <array> magnitude of pixel data fourier transform
@@ -152,12 +148,14 @@ def row_fftsignalprocessing(frequency_coordinates,
         frequenies: <array> fourier space frequency values of period peaks
         periods: <array> signal periods from fourier transform in nm
     '''
+    import scipy.signal as sig  # slow import, only the row by row path uses it
     peak_locations, _ = sig.find_peaks(x=absolute_intensity)
     prominences, _, _ = sig.peak_prominences(
         x=absolute_intensity,
         peaks=peak_locations)
-    prominence_sorted_locations = np.array(
-        np.argsort(prominences)[-number_of_frequencies:][::-1])
+    prominence_sorted_locations = np.argsort(
+        -prominences,
+        kind='stable')[:number_of_frequencies]
     selected_peak_locations = peak_locations[prominence_sorted_locations]
     frequency_steps = [
         p / (micrometers_per_pixel * sample_size)
@@ -167,16 +165,944 @@ def row_fftsignalprocessing(frequency_coordinates,
     return frequencies, periods
 
 
+def row_statistics(region):
+    '''
+    Calculate the mean and standard deviation of every row of a pixel region.
+    Args:
+        region: <array> 2D pixel array of grating region/analysis region
+    Returns:
+        row_means: <array> mean pixel value of each row
+        row_deviations: <array> standard deviation of each row's pixel values
+    '''
+    row_means = np.mean(region, axis=1)
+    row_deviations = np.std(region, axis=1)
+    return row_means, row_deviations
+
+
+def mean_thresholds(region,
+                    row_means,
+                    row_deviations):
+    '''
+    Mean thresholding, each row is thresholded at its mean pixel value.
+    Args:
+        region: <array> 2D pixel array of grating region/analysis region
+        row_means: <array> mean pixel value of each row
+        row_deviations: <array> standard deviation of each row's pixel values
+    Returns:
+        thresholds: <array> threshold pixel value of each row
+    '''
+    return row_means
+
+
+def mean_plus_deviation_thresholds(region,
+                                   row_means,
+                                   row_deviations):
+    '''
+    Mean+StdDev thresholding, each row is thresholded one standard deviation
+    above its mean pixel value.
+    Args:
+        region: <array> 2D pixel array of grating region/analysis region
+        row_means: <array> mean pixel value of each row
+        row_deviations: <array> standard deviation of each row's pixel values
+    Returns:
+        thresholds: <array> threshold pixel value of each row
+    '''
+    return row_means + row_deviations
+
+
+def mean_minus_deviation_thresholds(region,
+                                    row_means,
+                                    row_deviations):
+    '''
+    Mean-StdDev thresholding, each row is thresholded one standard deviation
+    below its mean pixel value.
+    Args:
+        region: <array> 2D pixel array of grating region/analysis region
+        row_means: <array> mean pixel value of each row
+        row_deviations: <array> standard deviation of each row's pixel values
+    Returns:
+        thresholds: <array> threshold pixel value of each row
+    '''
+    return row_means - row_deviations
+
+
+def otsu_thresholds(region,
+                    row_means,
+                    row_deviations):
+    '''
+    Otsu thresholding, each row is thresholded at the pixel value that best
+    separates its 8-bit pixel histogram into two classes (maximum between
+    class variance). All row histograms are built in a single bincount.
+    Args:
+        region: <array> 2D pixel array of grating region/analysis region
+        row_means: <array> mean pixel value of each row
+        row_deviations: <array> standard deviation of each row's pixel values
+    Returns:
+        thresholds: <array> threshold pixel value of each row, the lowest pixel
+                    value of the upper class
+    '''
+    number_of_rows, number_of_columns = np.shape(region)
+    pixel_levels = np.arange(256)
+    pixels = np.clip(region, 0, 255).astype(int)
+    row_offsets = np.arange(number_of_rows)[:, np.newaxis] * 256
+    histograms = np.bincount(
+        (pixels + row_offsets).ravel(),
+        minlength=number_of_rows * 256).reshape(number_of_rows, 256)
+    probabilities = histograms / number_of_columns
+    class_weights = np.cumsum(probabilities, axis=1)
+    class_means = np.cumsum(probabilities * pixel_levels, axis=1)
+    total_means = class_means[:, -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between_variance = (
+            (total_means * class_weights - class_means) ** 2
+            / (class_weights * (1 - class_weights)))
+    between_variance = np.nan_to_num(between_variance, posinf=0)
+    return np.argmax(between_variance, axis=1) + 1
+
+
+def percentile_thresholds(percentile):
+    '''
+    Build a percentile thresholding function, each row is thresholded at the
+    given percentile of its pixel values. Register the returned function in
+    thresholding_functions to use it, e.g. thresholding_functions['P75'] =
+    percentile_thresholds(percentile=75).
+    Args:
+        percentile: <float> percentile (0-100) to threshold at
+    Returns:
+        thresholds_function: <function> thresholding function
+    '''
+    def thresholds_function(region,
+                            row_means,
+                            row_deviations):
+        return np.percentile(region, percentile, axis=1)
+    return thresholds_function
+
+
+''' Thresholding method name: function of (region, row_means, row_deviations) '''
+thresholding_functions = {
+    'Mean': mean_thresholds,
+    'Mean+StdDev': mean_plus_deviation_thresholds,
+    'Mean-StdDev': mean_minus_deviation_thresholds,
+    'Otsu': otsu_thresholds,
+    'Median': percentile_thresholds(percentile=50)}
+
+
+def threshold_regions(region,
+                      thresholds):
+    '''
+    Threshold every row of a pixel region for several thresholding methods at
+    once. Row statistics are calculated once and shared between methods, each
+    row is compared to its own threshold value as in pixel_threshold.
+    Args:
+        region: <array> 2D pixel array of grating region/analysis region
+        thresholds: <array> thresholding method strings, None or any key of
+                    thresholding_functions
+    Returns:
+        binary_regions: <dict> thresholding method: 2D uint8 binary (0/255)
+                        pixel array, the unaltered region for None
+    '''
+    methods = [threshold for threshold in thresholds if threshold != 'None']
+    binary_regions = {'None': region}
+    if len(methods) > 0:
+        row_means, row_deviations = row_statistics(region=region)
+        threshold_values = np.array([
+            thresholding_functions[threshold](
+                region=region,
+                row_means=row_means,
+                row_deviations=row_deviations)
+            for threshold in methods])
+        binary = (
+            region[np.newaxis, :, :]
+            >= threshold_values[:, :, np.newaxis]).astype(np.uint8)
+        binary *= 255
+        binary_regions.update(dict(zip(methods, binary)))
+    return {threshold: binary_regions[threshold] for threshold in thresholds}
+
+
+def threshold_region(region,
+                     threshold):
+    '''
+    Threshold every row of a pixel region in one pass for a single method.
+    Args:
+        region: <array> 2D pixel array of grating region/analysis region
+        threshold: <string> None or any key of thresholding_functions
+    Returns:
+        thresholded_region: <array> 2D uint8 binary (0/255) pixel array, or
+                            the unaltered region if threshold is None
+    '''
+    return threshold_regions(
+        region=region,
+        thresholds=[threshold])[threshold]
+
+
+def calc_region_freqs(region):
+    '''
+    Calculate Fourier transform of every image row in a single axis-wise real
+    FFT.
+    Args:
+        region: <array> 2D pixel array, one image row per array row
+    Returns:
+        sample_size: <int> length of each row (sample length)
+        frequency_coordinates: <array> frequency space x-axis array, shared by
+                                all rows
+        absolute_intensities: <array> 2D magnitude of each row's fourier
+                                transform
+    '''
+    sample_size = np.shape(region)[1]
+    frequency_coordinates = np.fft.rfftfreq(sample_size, 1)
+    frequency_intensities = np.fft.rfft(region, axis=1)
+    absolute_intensities = np.abs(frequency_intensities)
+    return sample_size, frequency_coordinates, absolute_intensities
+
+
+def region_peak_locations(absolute_intensities):
+    '''
+    Find local maxima along every row of a 2D array. Follows scipy's find_peaks
+    conventions: flat peaks return their middle sample (rounded down) and the
+    first and last samples of a row are never peaks.
+    Args:
+        absolute_intensities: <array> 2D array, peaks found along each row
+    Returns:
+        peak_rows: <array> row index of each peak, in ascending order
+        peak_locations: <array> column index of each peak
+    '''
+    number_of_columns = np.shape(absolute_intensities)[1]
+    changes = absolute_intensities[:, 1:] != absolute_intensities[:, :-1]
+    if np.all(changes):
+        peaks = (
+            (absolute_intensities[:, 1: -1] > absolute_intensities[:, : -2])
+            & (absolute_intensities[:, 1: -1] > absolute_intensities[:, 2:]))
+        peak_rows, peak_locations = np.nonzero(peaks)
+        return peak_rows, peak_locations + 1
+
+    ''' Flat peaks, compare the samples either side of each plateau '''
+    run_starts = np.ones(np.shape(absolute_intensities), dtype=bool)
+    run_starts[:, 1:] = changes
+    run_ends = np.ones(np.shape(absolute_intensities), dtype=bool)
+    run_ends[:, :-1] = changes
+    run_rows, start_columns = np.nonzero(run_starts)
+    _, end_columns = np.nonzero(run_ends)
+    interior = (start_columns > 0) & (end_columns < number_of_columns - 1)
+    run_rows = run_rows[interior]
+    start_columns = start_columns[interior]
+    end_columns = end_columns[interior]
+    values = absolute_intensities[run_rows, start_columns]
+    peaks = (
+        (absolute_intensities[run_rows, start_columns - 1] < values)
+        & (absolute_intensities[run_rows, end_columns + 1] < values))
+    peak_locations = (start_columns[peaks] + end_columns[peaks]) // 2
+    return run_rows[peaks], peak_locations
+
+
+def range_tables(x):
+    '''
+    Build sparse tables of window maxima and minima along each row, level k
+    holds the maximum/minimum of x[:, i: i + 2 ** k]. Windows that run off the
+    end of the row are set to infinity.
+    Args:
+        x: <array> 2D data array
+    Returns:
+        maximum_table: <array> 3D array (level, row, column) of window maxima
+        minimum_table: <array> 3D array (level, row, column) of window minima
+    '''
+    number_of_columns = np.shape(x)[1]
+    levels = number_of_columns.bit_length()
+    maximum_table = np.empty((levels, ) + np.shape(x))
+    minimum_table = np.empty((levels, ) + np.shape(x))
+    maximum_table[0] = x
+    minimum_table[0] = x
+    for level in range(1, levels):
+        step = 2 ** (level - 1)
+        valid = number_of_columns - 2 * step + 1
+        maximum_table[level, :, valid:] = np.inf
+        minimum_table[level, :, valid:] = np.inf
+        maximum_table[level, :, :valid] = np.maximum(
+            maximum_table[level - 1, :, :valid],
+            maximum_table[level - 1, :, step: step + valid])
+        minimum_table[level, :, :valid] = np.minimum(
+            minimum_table[level - 1, :, :valid],
+            minimum_table[level - 1, :, step: step + valid])
+    return maximum_table, minimum_table
+
+
+def region_peak_prominences(absolute_intensities,
+                            peak_rows,
+                            peak_locations):
+    '''
+    Calculate prominence of every peak in a 2D array with array operations.
+    Matches scipy's peak_prominences without a window length, the bases of a
+    peak are the lowest points between the peak and the nearest higher sample
+    (or row edge) on either side.
+    Args:
+        absolute_intensities: <array> 2D array, peaks found along each row
+        peak_rows: <array> row index of each peak
+        peak_locations: <array> column index of each peak
+    Returns:
+        prominences: <array> prominence of each peak
+    '''
+    number_of_columns = np.shape(absolute_intensities)[1]
+    maximum_table, minimum_table = range_tables(x=absolute_intensities)
+    levels = np.shape(maximum_table)[0]
+    maximum_table = maximum_table.reshape(levels, -1)
+    minimum_table = minimum_table.reshape(levels, -1)
+    row_starts = peak_rows * number_of_columns
+    peak_values = absolute_intensities[peak_rows, peak_locations]
+
+    ''' Widen each peak's window while it contains no higher sample '''
+    left_edges = peak_locations
+    right_edges = peak_locations
+    for level in range(levels - 1, -1, -1):
+        step = 2 ** level
+        left_steps = left_edges - step
+        extend_left = (left_steps >= 0) & (
+            maximum_table[level][row_starts + np.maximum(left_steps, 0)]
+            <= peak_values)
+        left_edges = np.where(extend_left, left_steps, left_edges)
+        right_steps = right_edges + step
+        extend_right = (right_steps <= number_of_columns - 1) & (
+            maximum_table[level][
+                row_starts + np.minimum(right_edges + 1, number_of_columns - 1)]
+            <= peak_values)
+        right_edges = np.where(extend_right, right_steps, right_edges)
+
+    ''' Minimum of each window from two overlapping table entries '''
+    left_levels = np.log2(peak_locations - left_edges + 1).astype(int)
+    left_minima = np.minimum(
+        minimum_table[left_levels, row_starts + left_edges],
+        minimum_table[
+            left_levels,
+            row_starts + peak_locations - 2 ** left_levels + 1])
+    right_levels = np.log2(right_edges - peak_locations + 1).astype(int)
+    right_minima = np.minimum(
+        minimum_table[right_levels, row_starts + peak_locations],
+        minimum_table[
+            right_levels,
+            row_starts + right_edges - 2 ** right_levels + 1])
+    return peak_values - np.maximum(left_minima, right_minima)
+
+
+def region_fftsignalprocessing(frequency_coordinates,
+                               absolute_intensities,
+                               micrometers_per_pixel,
+                               sample_size,
+                               number_of_frequencies,
+                               block_size=128):
+    '''
+    Process fourier transforms of every image row to find periods and
+    frequencies. Array equivalent of row_fftsignalprocessing, rows are handled
+    in blocks to bound the size of the prominence tables. Peaks are taken in
+    the same order, equal prominences in order of increasing frequency. Rows
+    with fewer peaks than number_of_frequencies, including rows of narrow
+    regions whose spectrum is shorter than number_of_frequencies, are padded
+    with nan.
+    Args:
+        frequency_coordinates: <array> frequency space x-axis array
+        absolute_intensities: <array> 2D magnitude of each row's fourier
+                                transform
+        micrometers_per_pixel: <float> distance in um per pixel
+        sample_size: <int> length of row (sample length)
+        number_of_frequencies: <int> number of peaks to pull from fourier
+                                transform (number of periods to analyse)
+        block_size: <int> number of rows processed at once
+    Returns:
+        frequencies: <array> fourier space frequency values of period peaks,
+                        one row per image row, nan if the row has too few peaks
+        periods: <array> signal periods from fourier transform in nm, one row
+                    per image row, nan if the row has too few peaks
+    '''
+    number_of_rows = np.shape(absolute_intensities)[0]
+    frequencies = np.full((number_of_rows, number_of_frequencies), np.nan)
+    periods = np.full((number_of_rows, number_of_frequencies), np.nan)
+    for start in range(0, number_of_rows, block_size):
+        block = absolute_intensities[start: start + block_size]
+        block_rows = np.shape(block)[0]
+        peak_rows, peak_locations = region_peak_locations(
+            absolute_intensities=block)
+
+        ''' Pad each row's peaks into a (row, peak) array for sorting '''
+        peak_counts = np.bincount(peak_rows, minlength=block_rows)
+        row_offsets = np.cumsum(peak_counts) - peak_counts
+        peak_index = np.arange(len(peak_rows)) - row_offsets[peak_rows]
+        padded_width = max(np.max(peak_counts), number_of_frequencies)
+
+        '''
+        A peak's prominence is at least its height above its higher neighbour
+        and at most its height above the row minimum, so peaks that cannot
+        reach a row's top prominences are skipped.
+        '''
+        peak_values = block[peak_rows, peak_locations]
+        lower_bounds = peak_values - np.maximum(
+            block[peak_rows, peak_locations - 1],
+            block[peak_rows, peak_locations + 1])
+        padded_bounds = np.full((block_rows, padded_width), -np.inf)
+        padded_bounds[peak_rows, peak_index] = lower_bounds
+        cutoffs = -np.partition(
+            -padded_bounds,
+            number_of_frequencies - 1,
+            axis=1)[:, number_of_frequencies - 1]
+        upper_bounds = peak_values - np.min(block, axis=1)[peak_rows]
+        candidates = upper_bounds >= cutoffs[peak_rows]
+        prominences = np.full(len(peak_rows), -np.inf)
+        prominences[candidates] = region_peak_prominences(
+            absolute_intensities=block,
+            peak_rows=peak_rows[candidates],
+            peak_locations=peak_locations[candidates])
+        padded_prominences = np.full((block_rows, padded_width), -np.inf)
+        padded_prominences[peak_rows, peak_index] = prominences
+        padded_locations = np.ones((block_rows, padded_width), dtype=int)
+        padded_locations[peak_rows, peak_index] = peak_locations
+        prominence_sorted_locations = np.argsort(
+            -padded_prominences,
+            axis=1,
+            kind='stable')[:, :number_of_frequencies]
+        found = prominence_sorted_locations < peak_counts[:, np.newaxis]
+        selected_peak_locations = np.take_along_axis(
+            padded_locations,
+            prominence_sorted_locations,
+            axis=1)
+        frequency_steps = selected_peak_locations / (
+            micrometers_per_pixel * sample_size)
+        block_periods = (1 / frequency_steps) * 1E3
+
+        ''' Indexed by prominence rank, as in row_fftsignalprocessing '''
+        block_frequencies = np.take(
+            frequency_coordinates,
+            prominence_sorted_locations,
+            mode='clip')
+        frequencies[start: start + block_size] = np.where(
+            found, block_frequencies, np.nan)
+        periods[start: start + block_size] = np.where(
+            found, block_periods, np.nan)
+    return frequencies, periods
+
+
+def grating_period_results(frequencies,
+                           periods,
+                           threshold,
+                           sample_name):
+    '''
+    Average row periods and frequencies and calculate the errors using standard
+    error on the mean. Rows with too few fourier transform peaks (nan) are left
+    out of the averages.
+    Args:
+        frequencies: <array> 2D fourier space frequency values of period peaks,
+                        one row per image row
+        periods: <array> 2D signal periods in nm, one row per image row
+        threshold: <string> thresholding method used
+        sample_name: <string> sample name identifier string
+    Returns:
+        results: <dictionary> dictionary containing average period, period
+                errors, average frequency coordinates, frequency errors from the
+                fourier transform calculation
+    '''
+    rows = np.all(np.isfinite(periods), axis=1)
+    period_average = [mean_array(x=p) for p in periods[rows].T]
+    period_errors = [standard_error_mean(x=p) for p in periods[rows].T]
+    frequency_average = [mean_array(x=f) for f in frequencies[rows].T]
+    frequency_errors = [standard_error_mean(x=f) for f in frequencies[rows].T]
+    return {
+        f'{sample_name} Threshold Method': threshold,
+        f'{sample_name} Average Periods': period_average,
+        f'{sample_name} Period Errors': period_errors,
+        f'{sample_name} Average Frequencies': frequency_average,
+        f'{sample_name} Frequencies Errors': frequency_errors}
+
+
+def row_block_indices(number_of_rows,
+                      number_of_blocks):
+    '''
+    Split the rows of a region into blocks of consecutive rows.
+    Args:
+        number_of_rows: <int> number of rows in the region
+        number_of_blocks: <int> number of row blocks, reduced to the number of
+                            rows for small regions
+    Returns:
+        block_indices: <array> block index of each row
+    '''
+    block_starts = np.unique(
+        np.linspace(
+            0,
+            number_of_rows,
+            min(number_of_blocks, number_of_rows) + 1).astype(int)[:-1])
+    return np.searchsorted(
+        block_starts,
+        np.arange(number_of_rows),
+        side='right') - 1
+
+
+def interpolated_peak_periods(absolute_intensities,
+                              periods,
+                              micrometers_per_pixel,
+                              sample_size):
+    '''
+    Refine peak periods found on the FFT bins with sub-bin precision, by
+    fitting a parabola through each peak's bin and its neighbours, as in
+    zoomed_peak_frequencies. Averaged spectra vary too little between row
+    blocks to move their peaks to another bin, so block peaks are only
+    comparable (and their spread a usable error) once interpolated.
+    Args:
+        absolute_intensities: <array> 2D magnitude of each spectrum
+        periods: <array> 2D peak periods of each spectrum in nm, as returned
+                    by region_fftsignalprocessing, nan if not found
+        micrometers_per_pixel: <float> distance in um per pixel
+        sample_size: <int> length of row (sample length)
+    Returns:
+        periods: <array> interpolated peak periods in nm, nan if not found
+    '''
+    found = np.isfinite(periods)
+    bins = micrometers_per_pixel * sample_size * 1E3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centre = np.clip(
+            np.rint(np.where(found, bins / periods, 1)).astype(int),
+            1,
+            np.shape(absolute_intensities)[1] - 2)
+    rows = np.arange(len(absolute_intensities))[:, np.newaxis]
+    left = absolute_intensities[rows, centre - 1]
+    middle = absolute_intensities[rows, centre]
+    right = absolute_intensities[rows, centre + 1]
+    curvature = left - 2 * middle + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offsets = np.where(
+            curvature < 0,
+            0.5 * (left - right) / curvature,
+            0)
+    return np.where(found, bins / (centre + offsets), np.nan)
+
+
+def averaged_spectrum_results(frequencies,
+                              periods,
+                              threshold,
+                              sample_name):
+    '''
+    Results for an averaged spectrum analysis. Averages come from the peak
+    search of the spectrum averaged over every row, errors are the standard
+    error on the mean of the peak searches of the row block spectra, so they
+    are comparable to the per-row errors. Peak periods are interpolated
+    between FFT bins (interpolated_peak_periods), otherwise every block finds
+    the same bin and the period errors are 0. Blocks with too few peaks (nan)
+    are left out of the errors.
+    Args:
+        frequencies: <array> 2D fourier space frequency values of period peaks,
+                        whole region spectrum first then one row per block
+        periods: <array> 2D signal periods in nm, whole region spectrum first
+                    then one row per block
+        threshold: <string> thresholding method used
+        sample_name: <string> sample name identifier string
+    Returns:
+        results: <dictionary> dictionary containing average period, period
+                errors, average frequency coordinates, frequency errors from the
+                fourier transform calculation
+    '''
+    blocks = np.all(np.isfinite(periods[1:]), axis=1)
+    return {
+        f'{sample_name} Threshold Method': threshold,
+        f'{sample_name} Average Periods': list(periods[0]),
+        f'{sample_name} Period Errors': [
+            standard_error_mean(x=p) for p in periods[1:][blocks].T],
+        f'{sample_name} Average Frequencies': list(frequencies[0]),
+        f'{sample_name} Frequencies Errors': [
+            standard_error_mean(x=f) for f in frequencies[1:][blocks].T]}
+
+
+def diagnostic_rows(number_of_rows,
+                    plot_rows):
+    '''
+    Evenly spaced sample of rows kept for the diagnostic plots, so the memory
+    used for plotting does not grow with the image height.
+    Args:
+        number_of_rows: <int> number of rows in the region
+        plot_rows: <int> maximum number of rows to sample
+    Returns:
+        row_indices: <array> sorted indices of the sampled rows
+    '''
+    return np.unique(
+        np.linspace(
+            0,
+            number_of_rows - 1,
+            min(plot_rows, number_of_rows)).astype(int))
+
+
+def plot_grating_fft(frequency_coordinates,
+                     absolute_intensities,
+                     region,
+                     out_path,
+                     dpi=600):
+    '''
+    Plot the fourier transform and pixel values of sample rows from a grating
+    region to check the code works as intended. Plots are rendered in the
+    background (see plotting.submit_plot).
+    Args:
+        frequency_coordinates: <array> frequency space x-axis array, shared by
+                                every sampled row
+        absolute_intensities: <array> 2D magnitude of each sampled row's
+                                fourier transform
+        region: <array> 2D (thresholded) pixel array of the sampled rows
+        out_path: <string> path to save figures
+        dpi: <int> saved figure resolution in dots per inch
+    Returns:
+        None
+    '''
+    submit_plot(
+        plot_function=multi_xsys_plot,
+        xs=[frequency_coordinates] * len(absolute_intensities),
+        ys=absolute_intensities,
+        x_label='Frequency [1/p]',
+        y_label='Absolute Intensity [au]',
+        title='Fourier Transform',
+        out_path=Path(f'{out_path}_FFT.png'),
+        dpi=dpi)
+    submit_plot(
+        plot_function=multiy_plot,
+        ys=region,
+        x_label='Pixels [p]',
+        y_label='Pixel Intensity [au]',
+        title='Row',
+        out_path=Path(f'{out_path}_Rows.png'),
+        dpi=dpi)
+
+
+def multi_threshold_grating_frequency(grating,
+                                      distance_per_pixel,
+                                      thresholds,
+                                      sample_name,
+                                      plot_files,
+                                      out_path,
+                                      spectrum_mode='Rows',
+                                      number_of_blocks=16,
+                                      plot_rows=10,
+                                      row_chunk_size=128,
+                                      plot_dpi=600,
+                                      diagnostics=None):
+    '''
+    Process grating frequency coordinates and periods for several thresholding
+    methods in one fused pass. Row statistics are shared between methods, and
+    the thresholded rows are stacked so that every method's rows go through a
+    single Fourier transform and peak search. The region is processed in
+    chunks of rows, only per-row periods (Rows) or running block spectrum sums
+    (Averaged) are kept between chunks, so peak memory does not grow with the
+    image height. In Averaged spectrum mode the magnitude spectra are averaged
+    over the whole region and over blocks of rows before the peak search,
+    which is then run once per block rather than once per row. Spectra and
+    rows for the diagnostic plots are only kept if plot_files is "True".
+    Args:
+        grating: <array> pixel array of grating region/analysis region
+        distance_per_pixel: <float> distance in um per pixel
+        thresholds: <array> thresholding method strings, None or any key of
+                    thresholding_functions
+        sample_name: <string> sample name identifier string
+        plot_files: <string> "True" or "False"
+        out_path: <string> path to save figures if plot_files "True"
+        spectrum_mode: <string> Rows - peak search every row's spectrum and
+                                    average the row periods
+                                Averaged - peak search the row averaged
+                                    spectrum, errors from row blocks
+        number_of_blocks: <int> number of row blocks for Averaged errors
+        plot_rows: <int> number of evenly spaced rows kept for plotting
+        row_chunk_size: <int> number of image rows processed at once
+        plot_dpi: <int> plot resolution in dots per inch
+        diagnostics: <dict> if given, filled with thresholding method:
+                        (frequency coordinates, sampled spectra, sampled rows)
+                        for plotting later, whether or not plot_files is "True"
+    Returns:
+        results: <dict> thresholding method: results dictionary, as returned
+                by threshold_grating_frequency
+    '''
+    methods = list(dict.fromkeys(thresholds))
+    number_of_methods = len(methods)
+    number_of_rows, number_of_columns = np.shape(grating)
+    number_of_coordinates = number_of_columns // 2 + 1
+    averaged = spectrum_mode == 'Averaged'
+    if averaged:
+        block_indices = row_block_indices(
+            number_of_rows=number_of_rows,
+            number_of_blocks=number_of_blocks)
+        block_sums = np.zeros(
+            (number_of_methods, block_indices[-1] + 1, number_of_coordinates))
+    else:
+        frequencies = np.empty((number_of_methods, number_of_rows, 5))
+        periods = np.empty((number_of_methods, number_of_rows, 5))
+    if plot_files == 'True' or diagnostics is not None:
+        plot_indices = diagnostic_rows(
+            number_of_rows=number_of_rows,
+            plot_rows=plot_rows)
+    else:
+        plot_indices = np.array([], dtype=int)
+    plot_spectra = np.empty(
+        (number_of_methods, len(plot_indices), number_of_coordinates))
+    plot_regions = np.empty(
+        (number_of_methods, len(plot_indices), number_of_columns))
+
+    for start in range(0, number_of_rows, row_chunk_size):
+        chunk = slice(start, start + row_chunk_size)
+        binary_regions = threshold_regions(
+            region=grating[chunk],
+            thresholds=methods)
+        sample_size, freq_coords, abs_intensities = calc_region_freqs(
+            region=np.concatenate(list(binary_regions.values())))
+        if averaged:
+            np.add.at(
+                block_sums,
+                (np.arange(number_of_methods)[:, np.newaxis],
+                    block_indices[chunk][np.newaxis, :]),
+                abs_intensities.reshape(
+                    number_of_methods, -1, number_of_coordinates))
+        else:
+            chunk_frequencies, chunk_periods = region_fftsignalprocessing(
+                frequency_coordinates=freq_coords,
+                absolute_intensities=abs_intensities,
+                micrometers_per_pixel=distance_per_pixel,
+                sample_size=sample_size,
+                number_of_frequencies=5)
+            frequencies[:, chunk] = chunk_frequencies.reshape(
+                number_of_methods, -1, 5)
+            periods[:, chunk] = chunk_periods.reshape(
+                number_of_methods, -1, 5)
+
+        ''' Keep the diagnostic rows that fall in this chunk '''
+        captured = (plot_indices >= start) & (
+            plot_indices < start + row_chunk_size)
+        if np.any(captured):
+            chunk_rows = plot_indices[captured] - start
+            plot_spectra[:, captured] = abs_intensities.reshape(
+                number_of_methods,
+                -1,
+                number_of_coordinates)[:, chunk_rows]
+            plot_regions[:, captured] = [
+                region[chunk_rows] for region in binary_regions.values()]
+
+    if averaged:
+        block_sizes = np.bincount(block_indices)
+        spectra = np.concatenate(
+            [np.sum(block_sums, axis=1, keepdims=True) / number_of_rows,
+                block_sums / block_sizes[:, np.newaxis]],
+            axis=1)
+        spectra = spectra.reshape(-1, number_of_coordinates)
+        frequencies, periods = region_fftsignalprocessing(
+            frequency_coordinates=freq_coords,
+            absolute_intensities=spectra,
+            micrometers_per_pixel=distance_per_pixel,
+            sample_size=sample_size,
+            number_of_frequencies=5)
+        periods = interpolated_peak_periods(
+            absolute_intensities=spectra,
+            periods=periods,
+            micrometers_per_pixel=distance_per_pixel,
+            sample_size=sample_size)
+        frequencies = frequencies.reshape(number_of_methods, -1, 5)
+        periods = periods.reshape(number_of_methods, -1, 5)
+        period_results = averaged_spectrum_results
+    else:
+        period_results = grating_period_results
+    results = {}
+    for index, threshold in enumerate(methods):
+        results[threshold] = period_results(
+            frequencies=frequencies[index],
+            periods=periods[index],
+            threshold=threshold,
+            sample_name=sample_name)
+        if diagnostics is not None:
+            diagnostics[threshold] = (
+                freq_coords,
+                plot_spectra[index],
+                plot_regions[index])
+        if plot_files == 'True':
+            plot_grating_fft(
+                frequency_coordinates=freq_coords,
+                absolute_intensities=plot_spectra[index],
+                region=plot_regions[index],
+                out_path=out_path,
+                dpi=plot_dpi)
+    return results
+
+
+def calc_zoomed_freqs(region,
+                      design_frequency,
+                      zoom_band,
+                      zoom_points):
+    '''
+    Band-limited (zoomed) discrete Fourier transform of every image row around
+    the design frequency. Rows have their mean removed and a Hann window
+    applied, the band is sampled on a fine grid so the peak can be located
+    well below the FFT bin spacing. Costs two real matrix products, cheaper
+    than a full length zero-padded FFT.
+    Args:
+        region: <array> 2D pixel array, one image row per array row
+        design_frequency: <float> expected grating frequency in 1/pixels
+        zoom_band: <float> half width of the band as a fraction of the design
+                    frequency
+        zoom_points: <int> number of frequencies sampled across the band
+    Returns:
+        frequency_coordinates: <array> zoomed frequency axis in 1/pixels
+        absolute_intensities: <array> 2D magnitude of each row's zoomed
+                                fourier transform
+    '''
+    sample_size = np.shape(region)[1]
+    frequency_coordinates = np.linspace(
+        design_frequency * (1 - zoom_band),
+        design_frequency * (1 + zoom_band),
+        zoom_points)
+    window = np.hanning(sample_size)
+    rows = (region - np.mean(region, axis=1, keepdims=True)) * window
+    phases = 2 * np.pi * np.outer(np.arange(sample_size), frequency_coordinates)
+    real_parts = rows @ np.cos(phases)
+    imaginary_parts = rows @ np.sin(phases)
+    absolute_intensities = np.hypot(real_parts, imaginary_parts)
+    return frequency_coordinates, absolute_intensities
+
+
+def zoomed_peak_frequencies(frequency_coordinates,
+                            absolute_intensities):
+    '''
+    Locate each row's zoomed spectrum peak with sub-sample precision by fitting
+    a parabola through the largest sample and its neighbours.
+    Args:
+        frequency_coordinates: <array> zoomed frequency axis in 1/pixels
+        absolute_intensities: <array> 2D magnitude of each row's zoomed
+                                fourier transform
+    Returns:
+        frequencies: <array> peak frequency of each row in 1/pixels, nan if
+                        the peak is on the edge of the band
+    '''
+    number_of_points = len(frequency_coordinates)
+    peak_index = np.argmax(absolute_intensities, axis=1)
+    inside = (peak_index > 0) & (peak_index < number_of_points - 1)
+    centre = np.clip(peak_index, 1, number_of_points - 2)
+    rows = np.arange(len(absolute_intensities))
+    left = absolute_intensities[rows, centre - 1]
+    middle = absolute_intensities[rows, centre]
+    right = absolute_intensities[rows, centre + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offsets = 0.5 * (left - right) / (left - 2 * middle + right)
+    step = frequency_coordinates[1] - frequency_coordinates[0]
+    frequencies = frequency_coordinates[centre] + offsets * step
+    return np.where(inside, frequencies, np.nan)
+
+
+def zoomed_threshold_grating_frequency(grating,
+                                       distance_per_pixel,
+                                       thresholds,
+                                       sample_name,
+                                       design_period,
+                                       plot_files,
+                                       out_path,
+                                       zoom_band=0.25,
+                                       zoom_points=64,
+                                       plot_rows=10,
+                                       row_chunk_size=128,
+                                       plot_dpi=600,
+                                       diagnostics=None):
+    '''
+    Process grating periods for several thresholding methods with the zoomed
+    spectral estimator, which only looks at a band around the design period.
+    Each row's period comes from the interpolated peak of its zoomed spectrum,
+    periods are averaged and errors calculated using standard error on the
+    mean. Only the grating period (one peak) is reported per method. The
+    region is processed in chunks of rows, as in
+    multi_threshold_grating_frequency.
+    Args:
+        grating: <array> pixel array of grating region/analysis region
+        distance_per_pixel: <float> distance in um per pixel
+        thresholds: <array> thresholding method strings, None or any key of
+                    thresholding_functions
+        sample_name: <string> sample name identifier string
+        design_period: <int> design period for grating in nm
+        plot_files: <string> "True" or "False"
+        out_path: <string> path to save figures if plot_files "True"
+        zoom_band: <float> half width of the band as a fraction of the design
+                    frequency
+        zoom_points: <int> number of frequencies sampled across the band
+        plot_rows: <int> number of evenly spaced rows kept for plotting
+        row_chunk_size: <int> number of image rows processed at once
+        plot_dpi: <int> plot resolution in dots per inch
+        diagnostics: <dict> if given, filled with thresholding method:
+                        (frequency coordinates, sampled spectra, sampled rows)
+                        for plotting later, whether or not plot_files is "True"
+    Returns:
+        results: <dict> thresholding method: results dictionary, as returned
+                by threshold_grating_frequency
+    '''
+    design_frequency = distance_per_pixel * 1E3 / design_period
+    methods = list(dict.fromkeys(thresholds))
+    number_of_methods = len(methods)
+    number_of_rows, number_of_columns = np.shape(grating)
+    frequencies = np.empty((number_of_methods, number_of_rows))
+    if plot_files == 'True' or diagnostics is not None:
+        plot_indices = diagnostic_rows(
+            number_of_rows=number_of_rows,
+            plot_rows=plot_rows)
+    else:
+        plot_indices = np.array([], dtype=int)
+    plot_spectra = np.empty(
+        (number_of_methods, len(plot_indices), zoom_points))
+    plot_regions = np.empty(
+        (number_of_methods, len(plot_indices), number_of_columns))
+
+    for start in range(0, number_of_rows, row_chunk_size):
+        chunk = slice(start, start + row_chunk_size)
+        binary_regions = threshold_regions(
+            region=grating[chunk],
+            thresholds=methods)
+        freq_coords, abs_intensities = calc_zoomed_freqs(
+            region=np.concatenate(list(binary_regions.values())),
+            design_frequency=design_frequency,
+            zoom_band=zoom_band,
+            zoom_points=zoom_points)
+        frequencies[:, chunk] = zoomed_peak_frequencies(
+            frequency_coordinates=freq_coords,
+            absolute_intensities=abs_intensities).reshape(
+                number_of_methods, -1)
+
+        ''' Keep the diagnostic rows that fall in this chunk '''
+        captured = (plot_indices >= start) & (
+            plot_indices < start + row_chunk_size)
+        if np.any(captured):
+            chunk_rows = plot_indices[captured] - start
+            plot_spectra[:, captured] = abs_intensities.reshape(
+                number_of_methods,
+                -1,
+                zoom_points)[:, chunk_rows]
+            plot_regions[:, captured] = [
+                region[chunk_rows] for region in binary_regions.values()]
+
+    periods = (distance_per_pixel / frequencies) * 1E3
+    results = {}
+    for index, threshold in enumerate(methods):
+        results[threshold] = grating_period_results(
+            frequencies=frequencies[index][:, np.newaxis],
+            periods=periods[index][:, np.newaxis],
+            threshold=threshold,
+            sample_name=sample_name)
+        if diagnostics is not None:
+            diagnostics[threshold] = (
+                freq_coords,
+                plot_spectra[index],
+                plot_regions[index])
+        if plot_files == 'True':
+            plot_grating_fft(
+                frequency_coordinates=freq_coords,
+                absolute_intensities=plot_spectra[index],
+                region=plot_regions[index],
+                out_path=out_path,
+                dpi=plot_dpi)
+    return results
+
+
 def threshold_grating_frequency(grating,
                                 distance_per_pixel,
                                 threshold,
                                 sample_name,
                                 plot_files,
-                                out_path):
+                                out_path,
+                                spectrum_mode='Rows',
+                                number_of_blocks=16,
+                                plot_rows=10,
+                                plot_dpi=600):
     '''
     Process grating frequency coordinates and periods, average and calculate the
-    errors using standard error on the mean. Pull 10 rows and plot the fourier
-    transform to ensure the code works as intended, default is not to plot.
+    errors using standard error on the mean. The whole region is thresholded,
+    Fourier transformed and peak searched in chunks of rows. Pull plot_rows
+    rows and plot the fourier transform to ensure the code works as intended,
+    default is not to plot.
     Args:
         grating: <array> pixel array of grating region/analysis region
         distance_per_pixel: <float> distance in um per pixel
@@ -185,76 +1111,32 @@ def threshold_grating_frequency(grating,
                                     above mean will be 255, below 0
                             StdDev - a mean-stddev threshold will be applied,
                                     anything above will be 255, below 0
+                            or any other key of thresholding_functions
         sample_name: <string> sample name identifier string
         plot_files: <string> "True" or "False"
         out_path: <string> path to save figures if plot_files "True"
+        spectrum_mode: <string> Rows or Averaged, see
+                        multi_threshold_grating_frequency
+        number_of_blocks: <int> number of row blocks for Averaged errors
+        plot_rows: <int> number of evenly spaced rows plotted
+        plot_dpi: <int> plot resolution in dots per inch
     Returns:
         results: <dictionary> dictionary containing average period, period
                 errors, average frequency coordinates, frequency errors from the
                 fourier transform calculation
     '''
-    periods = []
-    frequencies = []
-    frequency_coordinates = []
-    absolute_intensities = []
-    rows = []
-    for index, raw_row in enumerate(grating):
-        if threshold == 'Mean':
-            row = pixel_threshold(
-                raw_row=raw_row,
-                threshold=mean_array(x=raw_row))
-        elif threshold == 'Mean+StdDev':
-            row = pixel_threshold(
-                raw_row=raw_row,
-                threshold=mean_array(x=raw_row) + standard_deviation(x=raw_row))
-        elif threshold == 'Mean-StdDev':
-            row = pixel_threshold(
-                raw_row=raw_row,
-                threshold=mean_array(x=raw_row) - standard_deviation(x=raw_row))
-        else:
-            row = raw_row
-        sample_size, freq_coords, abs_intensity = calc_row_freqs(row=row)
-        grating_frequencies, grating_periods = row_fftsignalprocessing(
-            frequency_coordinates=freq_coords,
-            absolute_intensity=abs_intensity,
-            micrometers_per_pixel=distance_per_pixel,
-            sample_size=sample_size,
-            number_of_frequencies=5)
-        periods.append(grating_periods)
-        frequencies.append(grating_frequencies)
-        if index % (len(grating) / 100):
-            frequency_coordinates.append(freq_coords)
-            absolute_intensities.append(abs_intensity)
-            rows.append(row)
-
-    period_average = [mean_array(x=p) for p in np.array(periods).T]
-    period_errors = [standard_error_mean(
-        x=p) for p in np.array(periods).T]
-    frequency_average = [mean_array(x=f) for f in np.array(frequencies).T]
-    frequency_errors = [standard_error_mean(
-        x=f) for f in np.array(frequencies).T]
-
-    if plot_files == 'True':
-        multi_xsys_plot(
-            xs=frequency_coordinates,
-            ys=absolute_intensities,
-            x_label='Frequency [1/p]',
-            y_label='Absolute Intensity [au]',
-            title='Fourier Transform',
-            out_path=Path(f'{out_path}_FFT.png'))
-        multiy_plot(
-            ys=rows,
-            x_label='Pixels [p]',
-            y_label='Pixel Intensity [au]',
-            title='Row',
-            out_path=Path(f'{out_path}_Rows.png'))
-
-    return {
-        f'{sample_name} Threshold Method': threshold,
-        f'{sample_name} Average Periods': period_average,
-        f'{sample_name} Period Errors': period_errors,
-        f'{sample_name} Average Frequencies': frequency_average,
-        f'{sample_name} Frequencies Errors': frequency_errors}
+    results = multi_threshold_grating_frequency(
+        grating=grating,
+        distance_per_pixel=distance_per_pixel,
+        thresholds=[threshold],
+        sample_name=sample_name,
+        plot_files=plot_files,
+        out_path=out_path,
+        spectrum_mode=spectrum_mode,
+        number_of_blocks=number_of_blocks,
+        plot_rows=plot_rows,
+        plot_dpi=plot_dpi)
+    return results[threshold]
 
 
 def calculate_grating_frequency(grating_region,
@@ -262,11 +1144,28 @@ def calculate_grating_frequency(grating_region,
                                 sample_name,
                                 design_period,
                                 plot_files,
-                                out_path):
+                                out_path,
+                                thresholding_methods=(
+                                    'Mean',
+                                    'Mean-StdDev',
+                                    'Mean+StdDev',
+                                    'None'),
+                                spectrum_mode='Rows',
+                                number_of_blocks=16,
+                                period_estimator='FFT',
+                                zoom_band=0.25,
+                                zoom_points=64,
+                                plot_rows=10,
+                                plot_dpi=600,
+                                plot_methods='All'):
     '''
     Calculate grating frequency and optimise thresholding for rough images, only
     return thresholded data with minimum difference to design period. Catches
-    errors in SEM imaging, scum, or dirt on the grating surface.
+    errors in SEM imaging, scum, or dirt on the grating surface. The methods
+    are evaluated together on the full region by
+    multi_threshold_grating_frequency, which makes each extra method nearly
+    free. The Zoom period estimator instead analyses every method with
+    zoomed_threshold_grating_frequency.
     Args:
         grating_region: <array> pixel array of grating region/analysis region
         distance_per_pixel: <float> distance in um per pixel
@@ -274,30 +1173,77 @@ def calculate_grating_frequency(grating_region,
         design_period: <int> design period for grating
         plot_files: <string> "True" or "False"
         out_path: <string> path to save figures if plot_files "True"
+        thresholding_methods: <array> candidate thresholding methods, None or
+                                any key of thresholding_functions
+        spectrum_mode: <string> Rows - peak search every row's spectrum
+                                Averaged - fast mode, peak search the row
+                                    averaged spectrum, errors from row blocks
+        number_of_blocks: <int> number of row blocks for Averaged errors
+        period_estimator: <string> FFT - periods from full length FFT bins
+                            Zoom - high precision grating period from a zoomed
+                                spectrum around the design period
+        zoom_band: <float> Zoom band half width, fraction of design frequency
+        zoom_points: <int> number of frequencies sampled across the Zoom band
+        plot_rows: <int> number of evenly spaced rows plotted per method if
+                    plot_files "True"
+        plot_dpi: <int> plot resolution in dots per inch
+        plot_methods: <string> All - plot every thresholding method analysed
+                        Selected - only plot the selected thresholding method
     Returns:
         results: <dictionary> dictionary containing average period, period
                 errors, average frequency coordinates, frequency errors from the
                 fourier transform calculation
     '''
-    thresholding_methods = ['Mean', 'Mean-StdDev', 'Mean+StdDev', 'None']
-    grating_periods = []
-    grating_results = []
-    for threshold in thresholding_methods:
-        grating_parameters = threshold_grating_frequency(
+    diagnostics = None
+    method_plots = plot_files
+    if plot_files == 'True' and plot_methods == 'Selected':
+        diagnostics = {}
+        method_plots = 'False'
+    if period_estimator == 'Zoom':
+        threshold_results = zoomed_threshold_grating_frequency(
             grating=grating_region,
             distance_per_pixel=distance_per_pixel,
+            thresholds=thresholding_methods,
             sample_name=sample_name,
-            threshold=threshold,
-            plot_files=plot_files,
-            out_path=out_path)
-        grating_periods.append(
-            max(grating_parameters[f'{sample_name} Average Periods']))
-        grating_results.append(grating_parameters)
+            design_period=design_period,
+            plot_files=method_plots,
+            out_path=out_path,
+            zoom_band=zoom_band,
+            zoom_points=zoom_points,
+            plot_rows=plot_rows,
+            plot_dpi=plot_dpi,
+            diagnostics=diagnostics)
+    else:
+        threshold_results = multi_threshold_grating_frequency(
+            grating=grating_region,
+            distance_per_pixel=distance_per_pixel,
+            thresholds=thresholding_methods,
+            sample_name=sample_name,
+            plot_files=method_plots,
+            out_path=out_path,
+            spectrum_mode=spectrum_mode,
+            number_of_blocks=number_of_blocks,
+            plot_rows=plot_rows,
+            plot_dpi=plot_dpi,
+            diagnostics=diagnostics)
+    grating_results = list(threshold_results.values())
+    grating_periods = [
+        max(grating_parameters[f'{sample_name} Average Periods'])
+        for grating_parameters in grating_results]
     minimum_difference = [
         np.abs(design_period - period)
         for period in grating_periods]
     minimum_index = np.argmin(minimum_difference)
     grating_dictionary = grating_results[minimum_index]
+    if diagnostics is not None:
+        freq_coords, plot_spectra, plot_regions = diagnostics[
+            grating_dictionary[f'{sample_name} Threshold Method']]
+        plot_grating_fft(
+            frequency_coordinates=freq_coords,
+            absolute_intensities=plot_spectra,
+            region=plot_regions,
+            out_path=out_path,
+            dpi=plot_dpi)
     periods = grating_dictionary[f'{sample_name} Average Periods']
     errors = grating_dictionary[f'{sample_name} Period Errors']
     period_error = errors[
@@ -313,31 +1259,305 @@ def calculate_grating_frequency(grating_region,
     return results_dictionary
 
 
-def average_grating_period(period_dictionary):
+def smooth_rows(region,
+                smoothing_rows):
     '''
-    Average period values in array in dictionary.
+    Moving average of every smoothing_rows neighbouring rows, found from
+    cumulative sums in one pass. Averaging down the columns suppresses pixel
+    noise without blurring the edges of (near) vertical grating lines.
     Args:
-        period_dictionary: <dict> period values for various file keys
+        region: <array> 2D pixel array
+        smoothing_rows: <int> number of rows in each average
+    Returns:
+        smoothed: <array> 2D float array, smoothing_rows - 1 rows shorter than
+                    region
+    '''
+    smoothing_rows = max(1, min(int(smoothing_rows), len(region)))
+    sums = np.zeros((len(region) + 1, np.shape(region)[1]))
+    np.cumsum(region, axis=0, out=sums[1:])
+    return (sums[smoothing_rows:] - sums[: -smoothing_rows]) / smoothing_rows
+
+
+def region_run_lengths(mask,
+                       minimum_length=1):
+    '''
+    Run-length encode every row of a boolean array in one pass, finding the
+    lengths of the runs of True values. Runs touching the first or last column
+    are cut off by the region edge and runs shorter than minimum_length are
+    noise, neither are returned.
+    Args:
+        mask: <array> 2D boolean array, runs found along each row
+        minimum_length: <float> shortest run length kept in pixels
+    Returns:
+        run_rows: <array> row index of each run, in ascending order
+        run_lengths: <array> length of each run in pixels
+    '''
+    padded = np.zeros((np.shape(mask)[0], np.shape(mask)[1] + 2), dtype=np.int8)
+    padded[:, 1: -1] = mask
+    edges = np.diff(padded, axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+    run_lengths = run_ends - run_starts
+    kept = (
+        (run_starts > 0)
+        & (run_ends < np.shape(mask)[1])
+        & (run_lengths >= minimum_length))
+    return run_rows[kept], run_lengths[kept]
+
+
+def row_run_statistics(run_rows,
+                       run_lengths,
+                       number_of_rows,
+                       outlier_sigma):
+    '''
+    Mean run length of every row and its standard error on the mean, after
+    rejecting outliers. Runs more than outlier_sigma standard deviations from
+    their row's mean run length are outliers. Row statistics come from
+    bincounts, so the cost is linear in the number of runs.
+    Args:
+        run_rows: <array> row index of each run
+        run_lengths: <array> length of each run
+        number_of_rows: <int> number of rows in the region
+        outlier_sigma: <float> number of standard deviations from the row mean
+                        beyond which a run is rejected
+    Returns:
+        row_means: <array> mean run length of each row, nan if the row has no
+                    runs
+        row_errors: <array> standard error on the mean run length of each
+                    row, nan if the row has fewer than two runs
+    '''
+    def row_moments(rows, lengths):
+        counts = np.bincount(rows, minlength=number_of_rows)
+        sums = np.bincount(rows, weights=lengths, minlength=number_of_rows)
+        squares = np.bincount(
+            rows,
+            weights=lengths.astype(float) ** 2,
+            minlength=number_of_rows)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / counts
+            deviations = np.sqrt(np.maximum(squares / counts - means ** 2, 0))
+        return counts, means, deviations
+
+    _, means, deviations = row_moments(run_rows, run_lengths)
+    kept = (
+        np.abs(run_lengths - means[run_rows])
+        <= outlier_sigma * deviations[run_rows])
+    counts, means, deviations = row_moments(
+        run_rows[kept],
+        run_lengths[kept])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        errors = np.where(
+            counts > 1,
+            deviations / np.sqrt(counts - 1),
+            np.nan)
+    return means, errors
+
+
+def grating_fill_factor(grating,
+                        distance_per_pixel,
+                        grating_period,
+                        sample_name,
+                        threshold='Mean',
+                        outlier_sigma=2,
+                        smoothing_rows=8,
+                        minimum_run=0.2):
+    '''
+    Calculate grating fill factor from the widths of the grating lines. The
+    region is averaged over smoothing_rows neighbouring rows to suppress
+    noise, then each row is split into runs of pixels above (lines) and below
+    (gaps) its threshold. Runs cut off by the region edges and runs shorter
+    than minimum_run periods are dropped, outlying run lengths are rejected
+    row by row, and the fill factor of a row is its mean line width over the
+    grating period. Fill factor, line width and gap width are averaged over
+    the rows with errors calculated using standard error on the mean.
+    Args:
+        grating: <array> pixel array of grating region/analysis region
+        distance_per_pixel: <float> distance in um per pixel
+        grating_period: <float> grating period in nm
+        sample_name: <string> sample name identifier string
+        threshold: <string> key of thresholding_functions that separates lines
+                    from gaps
+        outlier_sigma: <float> number of standard deviations from a row's mean
+                        run length beyond which a run is rejected
+        smoothing_rows: <int> number of rows averaged before thresholding
+        minimum_run: <float> shortest run kept as a fraction of the grating
+                        period
+    Returns:
+        results: <dictionary> dictionary containing row fill factors and
+                errors, average fill factor, line width, gap width, and their
+                errors
+    '''
+    grating = smooth_rows(region=grating, smoothing_rows=smoothing_rows)
+    number_of_rows = len(grating)
+    minimum_length = minimum_run * grating_period / (distance_per_pixel * 1E3)
+    row_means, row_deviations = row_statistics(region=grating)
+    row_thresholds = thresholding_functions[threshold](
+        region=grating,
+        row_means=row_means,
+        row_deviations=row_deviations)[:, np.newaxis]
+    widths = {}
+    for name, mask in [
+            ('Line', grating > row_thresholds),
+            ('Gap', grating < row_thresholds)]:
+        run_rows, run_lengths = region_run_lengths(
+            mask=mask,
+            minimum_length=minimum_length)
+        run_means, run_errors = row_run_statistics(
+            run_rows=run_rows,
+            run_lengths=run_lengths,
+            number_of_rows=number_of_rows,
+            outlier_sigma=outlier_sigma)
+        widths[name] = (
+            run_means * distance_per_pixel * 1E3,
+            run_errors * distance_per_pixel * 1E3)
+    line_widths, line_errors = widths['Line']
+    gap_widths, _ = widths['Gap']
+    fill_factors = line_widths / grating_period
+    fill_factor_errors = line_errors / grating_period
+    rows = np.isfinite(fill_factors)
+    gaps = np.isfinite(gap_widths)
+    return {
+        f'{sample_name} Row Fill Factors': list(fill_factors),
+        f'{sample_name} Row Fill Factor Errors': list(fill_factor_errors),
+        f'{sample_name} Fill Factor': mean_array(x=fill_factors[rows]),
+        f'{sample_name} Fill Factor Error': standard_error_mean(
+            x=fill_factors[rows]),
+        f'{sample_name} Line Width': mean_array(x=line_widths[rows]),
+        f'{sample_name} Line Width Error': standard_error_mean(
+            x=line_widths[rows]),
+        f'{sample_name} Gap Width': mean_array(x=gap_widths[gaps]),
+        f'{sample_name} Gap Width Error': standard_error_mean(
+            x=gap_widths[gaps])}
+
+
+def grating_key(period_key):
+    '''
+    Grating a period belongs to, the secondary string up to its first
+    underscore, e.g. "P400" for "P400_G1".
+    Args:
+        period_key: <string> period dictionary key (secondary string)
+    Returns:
+        grating_key: <string> grating identifier
+    '''
+    return period_key.split('_')[0]
+
+
+def add_grating_period(aggregate,
+                       period_key,
+                       period):
+    '''
+    Add an image's period to a running grating aggregate, using Welford's
+    numerically stable update of the count, mean and sum of squared
+    differences from the mean.
+    Args:
+        aggregate: <dict> grating key: {"Count", "Mean", "Sum Squares"},
+                    updated in place, start from an empty dictionary
+        period_key: <string> period dictionary key (secondary string)
+        period: <float> image grating period
+    Returns:
+        None
+    '''
+    running = aggregate.setdefault(
+        grating_key(period_key=period_key),
+        {'Count': 0, 'Mean': 0.0, 'Sum Squares': 0.0})
+    running['Count'] += 1
+    delta = period - running['Mean']
+    running['Mean'] += delta / running['Count']
+    running['Sum Squares'] += delta * (period - running['Mean'])
+
+
+def remove_grating_period(aggregate,
+                          period_key,
+                          period):
+    '''
+    Remove an image's period from a running grating aggregate, reversing
+    add_grating_period. A grating with no periods left is removed.
+    Args:
+        aggregate: <dict> running grating aggregate, updated in place
+        period_key: <string> period dictionary key (secondary string)
+        period: <float> image grating period, as added
+    Returns:
+        None
+    '''
+    key = grating_key(period_key=period_key)
+    running = aggregate[key]
+    if running['Count'] == 1:
+        del aggregate[key]
+        return
+    previous_mean = running['Mean']
+    running['Count'] -= 1
+    running['Mean'] = (
+        previous_mean + (previous_mean - period) / running['Count'])
+    running['Sum Squares'] = max(
+        running['Sum Squares']
+        - (period - running['Mean']) * (period - previous_mean),
+        0.0)
+
+
+def merge_grating_aggregates(aggregate,
+                             other_aggregate):
+    '''
+    Combine running grating aggregates built from different images, e.g. by
+    different workers or shards, with Chan et al.'s parallel update.
+    Args:
+        aggregate: <dict> running grating aggregate
+        other_aggregate: <dict> running grating aggregate
+    Returns:
+        merged_aggregate: <dict> running grating aggregate of both
+    '''
+    merged_aggregate = {key: dict(value) for key, value in aggregate.items()}
+    for key, other in other_aggregate.items():
+        if key not in merged_aggregate:
+            merged_aggregate[key] = dict(other)
+            continue
+        running = merged_aggregate[key]
+        count = running['Count'] + other['Count']
+        delta = other['Mean'] - running['Mean']
+        running['Sum Squares'] += (
+            other['Sum Squares']
+            + delta ** 2 * running['Count'] * other['Count'] / count)
+        running['Mean'] += delta * other['Count'] / count
+        running['Count'] = count
+    return merged_aggregate
+
+
+def grating_aggregate_results(aggregate):
+    '''
+    Average period and standard error on the mean (as standard_error_mean) of
+    each grating in a running grating aggregate.
+    Args:
+        aggregate: <dict> running grating aggregate
     Returns:
         results_dictionary: <dict> average results for specific gratings
     '''
-    average_dictionary = {}
-    for key, value in period_dictionary.items():
-        key_split = key.split('_')
-        new_key = key_split[0]
-        if new_key in average_dictionary.keys():
-            average_dictionary[new_key].append(value)
-        else:
-            average_dictionary.update({new_key: [value]})
     results_dictionary = {}
-    for key, values in average_dictionary.items():
+    for key, running in aggregate.items():
         period_key = f'{key} Average'
         error_key = f'{key} Error'
-        if len(values) != 1:
-            results_dictionary.update(
-                {period_key: mean_array(x=values)})
-            results_dictionary.update(
-                {error_key: standard_error_mean(x=values)})
+        if running['Count'] != 1:
+            results_dictionary.update({period_key: running['Mean']})
+            results_dictionary.update({
+                error_key: np.sqrt(
+                    running['Sum Squares']
+                    / (running['Count'] * (running['Count'] - 1)))})
         else:
             results_dictionary.update({period_key: 'No Average Value'})
     return results_dictionary
+
+
+def average_grating_period(period_dictionary):
+    '''
+    Average period values in array in dictionary. Periods are added to a
+    running grating aggregate one image at a time, see add_grating_period.
+    Args:
+        period_dictionary: <dict> period values for various file keys
+    Returns:
+        results_dictionary: <dict> average results for specific gratings
+    '''
+    aggregate = {}
+    for key, value in period_dictionary.items():
+        add_grating_period(
+            aggregate=aggregate,
+            period_key=key,
+            period=value)
+    return grating_aggregate_results(aggregate=aggregate)
@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import tempfile
+
+from pathlib import Path
+from src.fileIO import convert
+
+
+'''
+Permissions of new cache and staging files, as open() would create them
+under the process umask. tempfile.mkstemp creates files readable by their
+owner only, which would hide a shared cache from other users and nodes.
+'''
+umask = os.umask(0)
+os.umask(umask)
+new_file_mode = 0o666 & ~umask
+
+def code_version():
+    '''
+    Version of the analysis code, a hash of the analysis module source. Any
+    change to the analysis (including default parameters) changes the version.
+    Args:
+        None
+    Returns:
+        version: <string> hex digest of src/analysis.py
+    '''
+    analysis_path = Path(f'{Path(__file__).parent}/analysis.py')
+    return hashlib.sha256(analysis_path.read_bytes()).hexdigest()
+
+
+def cache_key(image,
+              image_parameters,
+              analysis_parameters):
+    '''
+    Content address of an image analysis. Hashes the image pixels, the SEM log
+    parameters, the analysis parameters, and the analysis code version.
+    Args:
+        image: <array> pixel array that is analysed
+        image_parameters: <dict> SEM log parameters (see fileIO.read_SEM_log)
+        analysis_parameters: <dict> arguments passed to the analysis
+    Returns:
+        key: <string> hex digest cache key
+    '''
+    key = hashlib.sha256()
+    key.update(f'{image.shape} {image.dtype}'.encode())
+    key.update(image.tobytes())
+    for parameters in [image_parameters, analysis_parameters]:
+        key.update(
+            json.dumps(parameters, sort_keys=True, default=str).encode())
+    key.update(code_version().encode())
+    return key.hexdigest()
+
+
+def load_cached_results(cache_path,
+                        key):
+    '''
+    Load cached results for a cache key. A hit marks the entry as recently
+    used for eviction.
+    Args:
+        cache_path: <string> path to cache directory
+        key: <string> cache key from cache_key
+    Returns:
+        results: <dict> cached results dictionary, None if not cached
+    '''
+    file_path = Path(f'{cache_path}/{key}.json')
+    try:
+        with open(file_path, 'r') as file:
+            results = json.load(file)
+        os.utime(file_path)
+    except (OSError, ValueError):
+        return None
+    return results
+
+
+def save_cached_results(cache_path,
+                        key,
+                        results):
+    '''
+    Save results to the cache. The file is written to a temporary file and
+    renamed into place, so concurrent workers never read a partly written
+    entry. The cache is not evicted here, as scanning the cache after every
+    save is slow, the caller evicts it with evict_cache (e.g. once a batch).
+    Args:
+        cache_path: <string> path to cache directory
+        key: <string> cache key from cache_key
+        results: <dict> results dictionary to cache
+    Returns:
+        None
+    '''
+    os.makedirs(cache_path, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=cache_path,
+        suffix='.tmp')
+    with os.fdopen(file_descriptor, 'w') as file:
+        json.dump(results, file, default=convert)
+    os.chmod(temporary_path, new_file_mode)
+    os.replace(temporary_path, Path(f'{cache_path}/{key}.json'))
+
+
+def evict_cache(cache_path,
+                cache_size,
+                file_string='.json'):
+    '''
+    Remove least recently used cache entries until the cache fits in its size.
+    Entries removed by another worker in the meantime are skipped.
+    Args:
+        cache_path: <string> path to cache directory
+        cache_size: <int> maximum cache size in bytes
+        file_string: <string> file extension of cache entries
+    Returns:
+        None
+    '''
+    entries = []
+    for entry in os.scandir(cache_path):
+        if entry.name.endswith(file_string):
+            try:
+                status = entry.stat()
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, file_path in sorted(entries):
+        if total_size <= cache_size:
+            break
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+        total_size -= size
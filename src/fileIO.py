@@ -1,3 +1,4 @@
+import os
 import json
 import numpy as np
 from PIL import Image
@@ -111,6 +112,107 @@ def read_image(file_path):
     return np.array(image)
 
 
+''' PIL raw mode: (numpy dtype, channels) of memory mappable pixel data '''
+raw_modes = {
+    'L': ('u1', 1),
+    'I;16': ('<u2', 1),
+    'I;16B': ('>u2', 1),
+    'RGB': ('u1', 3),
+    'BGR': ('u1', 3),
+    'RGBX': ('u1', 4),
+    'BGRX': ('u1', 4)}
+
+
+def mapped_pixels(image,
+                  file_path):
+    '''
+    Memory map the pixel data of an uncompressed image opened (but not loaded)
+    by PIL, using the raw tiles PIL found in the file header. Strips must be
+    contiguous in the file, bottom-up BMP rows are mapped with a negative row
+    stride, so no pixels are read or copied.
+    Args:
+        image: <Image> unloaded PIL image
+        file_path: <string> path to image file
+    Returns:
+        pixels: <array> read-only (height, width) or (height, width, channels)
+                memory mapped pixel array, None if the pixel data can not be
+                memory mapped (compressed or unsupported layouts)
+    '''
+    tiles = image.tile
+    if len(tiles) == 0 or any(tile[0] != 'raw' for tile in tiles):
+        return None
+    arguments = tiles[0][3]
+    if isinstance(arguments, str):
+        arguments = (arguments, )
+    raw_mode, stride, direction = (tuple(arguments) + (0, 1))[0: 3]
+    if raw_mode not in raw_modes or stride < 0:
+        return None
+    dtype, channels = raw_modes[raw_mode]
+    width, height = image.size
+    pixel_bytes = np.dtype(dtype).itemsize * channels
+    if stride == 0:
+        stride = width * pixel_bytes
+    offset = tiles[0][2]
+    for tile in tiles:
+        left, top, right, bottom = tile[1]
+        row = top if direction == 1 else height - bottom
+        if (left, right) != (0, width) or tile[2] != offset + row * stride:
+            return None
+    pixels = np.asarray(np.memmap(
+        file_path,
+        dtype='u1',
+        mode='r',
+        offset=offset,
+        shape=(height, stride)))
+    pixels = pixels[:, 0: width * pixel_bytes].view(dtype)
+    pixels = pixels.reshape(height, width, channels)
+    if direction == -1:
+        pixels = pixels[::-1]
+    if raw_mode.startswith('BGR'):
+        pixels = pixels[:, :, 2::-1]
+    return pixels[:, :, 0] if channels == 1 else pixels
+
+
+def read_image_region(file_path,
+                      height=None,
+                      width=None):
+    '''
+    Load the region of interest of an image file as grayscale. Uncompressed
+    BMP and TIFF pixel data is memory mapped, so only the region of interest
+    is read from disk and nothing is copied. Colour images whose channels are
+    equal (grayscale saved as RGB) are viewed through one channel, other
+    colour images are converted to luminance as PIL does. Compressed images
+    are decoded by PIL.
+    Args:
+        file_path: <string> path to file
+        height: <int> number of pixels in vertical axis, None for all rows
+        width: <int> number of pixels in horizontal axis, None for all columns
+    Returns:
+        region_of_interest: <array> read-only 2D array of grayscale pixels
+    '''
+    with Image.open(file_path) as image:
+        pixels = mapped_pixels(image=image, file_path=file_path)
+        if pixels is None:
+            if image.mode not in ('L', 'I;16', 'I;16B', 'I', 'F'):
+                image = image.convert('L')
+            pixels = np.array(image)
+    region = pixels[0: height, 0: width]
+    if region.ndim == 3:
+        if all(
+                np.array_equal(region[:, :, 0], region[:, :, channel])
+                for channel in (1, 2)):
+            region = region[:, :, 0]
+        else:
+            region = region[:, :, 0: 3].astype(np.uint32)
+            region = (
+                (region[:, :, 0] * 19595
+                 + region[:, :, 1] * 38470
+                 + region[:, :, 2] * 7471
+                 + 0x8000) >> 16).astype(np.uint8)
+    region.setflags(write=False)
+    return region
+
+
 def convert(o):
     '''
     Check type of data string
@@ -137,3 +239,62 @@ def save_json_dicts(out_path,
             indent=2,
             default=convert)
         outfile.write('\n')
+
+
+def save_json_records(out_path,
+                      records):
+    '''
+    Save records to a newline delimited json file, one record per line.
+    Overwrites any existing file.
+    Args:
+        out_path: <string> path to file, including file name and extension
+        records: <array> python dictionaries to save out
+    Returns:
+        None
+    '''
+    with open(out_path, 'w') as outfile:
+        for record in records:
+            outfile.write(json.dumps(record, default=convert))
+            outfile.write('\n')
+
+
+def append_json_record(out_path,
+                       record):
+    '''
+    Append a record to a newline delimited json file. The line is flushed to
+    disk before returning, so a crash loses at most the record being written.
+    A partly written last line (from an earlier crash) is ended first.
+    Args:
+        out_path: <string> path to file, including file name and extension
+        record: <dict> python dictionary to append
+    Returns:
+        None
+    '''
+    with open(out_path, 'a+b') as outfile:
+        if outfile.tell() > 0:
+            outfile.seek(-1, os.SEEK_END)
+            if outfile.read(1) != b'\n':
+                outfile.write(b'\n')
+        outfile.write(json.dumps(record, default=convert).encode())
+        outfile.write(b'\n')
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+
+def load_json_records(file_path):
+    '''
+    Load records from a newline delimited json file. Lines that are not valid
+    json (a record cut short by a crash) are skipped.
+    Args:
+        file_path: <string> path to file
+    Returns:
+        records: <array> python dictionaries, in file order
+    '''
+    records = []
+    with open(file_path, 'r') as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
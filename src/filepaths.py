@@ -1,9 +1,9 @@
 import os
+import hashlib
 
 from pathlib import Path
 from sys import platform
 from src.fileIO import load_json
-from src.GUI import prompt_for_path
 
 
 def check_platform():
@@ -73,6 +73,7 @@ def get_files_paths(directory_path,
             file_string=file_string)
         file_paths = [Path(f'{directory_path}/{file}') for file in file_list]
     elif operating_system == 'Windows':
+        from src.GUI import prompt_for_path  # tkinter needs a display
         file_paths = prompt_for_path(
             default=directory_path,
             title='Select Target File(s)',
@@ -81,36 +82,91 @@ def get_files_paths(directory_path,
     return file_paths
 
 
+def build_log_index(log_path,
+                    file_string):
+    '''
+    Index log files in the log directory by primary and secondary string, so
+    each image's log can be found without searching the directory. Build once
+    per run and pass to find_semlog.
+    Args:
+        log_path: <string> path to log directory
+        file_string: <string> log file path extension
+    Returns:
+        log_index: <dict> (primary string, secondary string): array of
+                    (log file path, log details) pairs
+    '''
+    log_index = {}
+    for file in extractfile(directory_path=log_path, file_string=file_string):
+        index_log_file(
+            log_index=log_index,
+            file_path=Path(f'{log_path}/{file}'))
+    return log_index
+
+
+def index_log_file(log_index,
+                   file_path):
+    '''
+    Add a log file to a log index, e.g. one saved after the index was built.
+    Files whose names are not sample names (e.g. "notes.txt") are reported
+    and skipped, so a stray file does not stop the run.
+    Args:
+        log_index: <dict> log index from build_log_index, updated in place
+        file_path: <string> path to log file
+    Returns:
+        None
+    '''
+    try:
+        log_details = sample_information(file_path=file_path)
+    except (IndexError, ValueError):
+        file_name = get_filename(file_path=file_path)
+        print(f'{file_name}: not a sample log, skipped')
+        return
+    if len(log_details) == 0:
+        return
+    parent = log_details['Parent Directory']
+    key = (
+        log_details[f'{parent} Primary String'],
+        log_details[f'{parent} Secondary String'])
+    log_index.setdefault(key, []).append((file_path, log_details))
+
+
 def find_semlog(log_path,
                 sample_details,
-                file_string):
+                file_string,
+                log_index=None):
     '''
-    Find image log file from SEM.
+    Find image log file from SEM. Missing and ambiguous (more than one match)
+    log files are reported, ambiguous logs return every matching path.
     Args:
         log_path: <string> path to log directory
         sample_details: <dict> dictionary containing image sample information
         file_string: <string> log file path extension
+        log_index: <dict> log index from build_log_index, built from log_path
+                    if None
     Returns:
         log_file: <array> path to log file or empty if no file
         log_details: <dict> log parameters (same as sample_information)
     '''
-    parent = sample_details['Parent Directory']
-    primary = f'{parent} Primary String'
-    secondary = f'{parent} Secondary String'
-    try:
-        log_files = extractfile(
-            directory_path=log_path,
+    if log_index is None:
+        log_index = build_log_index(
+            log_path=log_path,
             file_string=file_string)
-        log_file = []
-        for file in log_files:
-            file_path = Path(f'{log_path}/{file}')
-            log_details = sample_information(file_path=file_path)
-            if log_details[primary] == sample_details[primary]:
-                if log_details[secondary] == sample_details[secondary]:
-                    log_file.append(file_path)
-    except:
-        log_file = []
-        log_details = {"Log String": "No Log File"}
+    parent = sample_details['Parent Directory']
+    file_name = sample_details[f'{parent} File Name']
+    key = (
+        sample_details[f'{parent} Primary String'],
+        sample_details[f'{parent} Secondary String'])
+    matches = log_index.get(key, [])
+    if len(matches) == 0:
+        print(f'{file_name}: no {file_string} log file in {log_path}')
+        return [], {'Log String': 'No Log File'}
+    log_file = [file_path for file_path, _ in matches]
+    log_details = matches[0][1]
+    if len(matches) > 1:
+        print(
+            f'{file_name}: {len(matches)} matching log files, using '
+            f'{log_file[0]}')
+        log_details = dict(log_details, **{'Log String': 'Ambiguous Log File'})
     return log_file, log_details
 
 
@@ -122,10 +178,7 @@ def get_parent_directory(file_path):
     Returns:
         parent_directory: <string> parent directory name (not path)
     '''
-    dirpath = os.path.dirname(file_path)
-    dirpathsplit = dirpath.split('\\')
-    parent_directory = dirpathsplit[-1]
-    return parent_directory
+    return Path(file_path).parent.name
 
 
 def get_filename(file_path):
@@ -218,6 +271,70 @@ def get_all_batches(file_paths):
     return parent, batches
 
 
+def shard_number(name,
+                 shard_count):
+    '''
+    Shard a batch or image belongs to, from a hash of its name. Every node
+    computes the same shard without coordination, and adding files to the
+    archive does not move other batches or images between shards.
+    Args:
+        name: <string> batch name or image file name
+        shard_count: <int> number of shards
+    Returns:
+        shard_index: <int> shard number, 0 to shard_count - 1
+    '''
+    digest = hashlib.sha256(f'{name}'.encode()).digest()
+    return int.from_bytes(digest[0: 8], 'big') % shard_count
+
+
+def shard_batches(batches,
+                  shard_index=0,
+                  shard_count=1,
+                  shard_by='Batch',
+                  manifest=None):
+    '''
+    Deterministic subset of the batches, or of the images in each batch, to
+    analyse on one of several nodes. Batches (or images, by file name) are
+    split by shard_number, or a manifest lists the batch names ("Batches")
+    and image file names without extension ("Images") of the shard.
+    Args:
+        batches: <dict> batch name: file paths, see get_all_batches
+        shard_index: <int> this node's shard number, 0 to shard_count - 1
+        shard_count: <int> number of shards
+        shard_by: <string> "Batch" or "Image" split
+        manifest: <dict> "Batches" and/or "Images" lists, used instead of the
+                    shard number and count if given
+    Returns:
+        shard: <dict> batch name: file paths analysed by this shard, batches
+                with no files in the shard are left out
+    '''
+    shard = {}
+    for batch_name, file_paths in batches.items():
+        if manifest is not None:
+            if batch_name in manifest.get('Batches', []):
+                shard_paths = list(file_paths)
+            else:
+                shard_paths = [
+                    file for file in file_paths
+                    if get_filename(file_path=file)
+                    in manifest.get('Images', [])]
+        elif shard_by == 'Image':
+            shard_paths = [
+                file for file in file_paths
+                if shard_number(
+                    name=get_filename(file_path=file),
+                    shard_count=shard_count) == shard_index]
+        elif shard_number(
+                name=batch_name,
+                shard_count=shard_count) == shard_index:
+            shard_paths = list(file_paths)
+        else:
+            shard_paths = []
+        if len(shard_paths) > 0:
+            shard.update({batch_name: shard_paths})
+    return shard
+
+
 def update_batch_dictionary(parent,
                             batch_name,
                             file_paths):
@@ -0,0 +1,158 @@
+import time
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+
+
+'''
+Stage name: timings of the image being handled, kept per thread so images
+loaded in the background are timed separately from the image being analysed
+'''
+thread_stages = threading.local()
+
+
+def image_stages():
+    '''
+    Stage timings dictionary of the calling thread.
+    Args:
+        None
+    Returns:
+        stages: <dict> stage name: wall time, CPU time, peak memory
+    '''
+    if not hasattr(thread_stages, 'stages'):
+        thread_stages.stages = {}
+    return thread_stages.stages
+
+
+def start_memory_tracing():
+    '''
+    Start tracing memory allocations (tracemalloc) in this process, so each
+    stage records its peak memory. Tracing slows the analysis by about 25%,
+    so it is only started when asked for. Call in each worker process, e.g.
+    as the process pool initializer. Needs python 3.9 or later.
+    Args:
+        None
+    Returns:
+        None
+    '''
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def reset_stages():
+    '''
+    Clear the calling thread's stage timings, call before handling each
+    image.
+    Args:
+        None
+    Returns:
+        None
+    '''
+    image_stages().clear()
+
+
+def record_stage(stage_name,
+                 wall_time,
+                 cpu_time=None,
+                 memory=None):
+    '''
+    Add a stage's timings to the calling thread's current image. A stage that
+    runs more than once has its times summed and the largest peak memory
+    kept.
+    Args:
+        stage_name: <string> pipeline stage name
+        wall_time: <float> wall time in seconds
+        cpu_time: <float> thread CPU time in seconds, None if not measured
+        memory: <float> peak memory allocated during the stage in MB, None if
+                not measured
+    Returns:
+        None
+    '''
+    timings = image_stages().setdefault(
+        stage_name,
+        {'Wall Time': 0, 'CPU Time': None, 'Peak Memory': None})
+    timings['Wall Time'] += wall_time
+    if cpu_time is not None:
+        timings['CPU Time'] = (timings['CPU Time'] or 0) + cpu_time
+    if memory is not None:
+        timings['Peak Memory'] = max(timings['Peak Memory'] or 0, memory)
+
+
+@contextmanager
+def stage(stage_name):
+    '''
+    Time a pipeline stage, recording wall time and the CPU time of the
+    calling thread, so background reading and plotting threads are not
+    counted. If memory is traced (start_memory_tracing), the stage's peak
+    memory is also recorded: the most memory allocated above the stage's
+    start at any point during it. The traced peak is per process, so
+    allocations by other threads during the stage are included.
+    Args:
+        stage_name: <string> pipeline stage name
+    Returns:
+        None
+    '''
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        memory_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        memory = None
+        if tracing:
+            memory = (tracemalloc.get_traced_memory()[1] - memory_start) / 1E6
+        record_stage(
+            stage_name=stage_name,
+            wall_time=time.perf_counter() - wall_start,
+            cpu_time=time.thread_time() - cpu_start,
+            memory=memory)
+
+
+def stage_timings():
+    '''
+    Stage timings of the calling thread's current image.
+    Args:
+        None
+    Returns:
+        timings: <dict> stage name: wall time, CPU time, peak memory
+    '''
+    return {
+        stage_name: dict(timings)
+        for stage_name, timings in image_stages().items()}
+
+
+def aggregate_timings(image_timings):
+    '''
+    Aggregate per-image stage timings over a batch.
+    Args:
+        image_timings: <dict> image name: stage timings from stage_timings
+    Returns:
+        batch_timings: <dict> stage name: number of images, total and mean
+                        wall time, maximum wall time, total CPU time, and
+                        maximum peak memory
+    '''
+    batch_timings = {}
+    for timings in image_timings.values():
+        for stage_name, stage_values in timings.items():
+            batch_timings.setdefault(stage_name, []).append(stage_values)
+    aggregate = {}
+    for stage_name, values in batch_timings.items():
+        wall_times = [value['Wall Time'] for value in values]
+        cpu_times = [
+            value['CPU Time'] for value in values
+            if value['CPU Time'] is not None]
+        memories = [
+            value['Peak Memory'] for value in values
+            if value['Peak Memory'] is not None]
+        aggregate[stage_name] = {
+            'Images': len(values),
+            'Total Wall Time': sum(wall_times),
+            'Mean Wall Time': sum(wall_times) / len(values),
+            'Max Wall Time': max(wall_times),
+            'Total CPU Time': sum(cpu_times) if cpu_times else None,
+            'Max Peak Memory': max(memories) if memories else None}
+    return aggregate
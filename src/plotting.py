@@ -1,4 +1,40 @@
-import matplotlib.pyplot as plt
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+''' Figures are rendered by one background thread per process '''
+plot_executor = None
+plot_slots = threading.BoundedSemaphore(16)
+figures = {}
+render_time = 0
+
+
+def reusable_axes(figure_name):
+    '''
+    Figure and axes for a type of plot. Figures are drawn on the
+    non-interactive Agg canvas, created once per process and cleared for
+    reuse, which is much cheaper than building a new figure for every plot.
+    Only the plotting thread should call this. Matplotlib is imported here,
+    on first use, so importing this module (and src.analysis) stays cheap
+    when nothing is plotted.
+    Args:
+        figure_name: <string> plot type identifier
+    Returns:
+        fig: <Figure> matplotlib figure
+        ax: <Axes> cleared figure axes
+    '''
+    if figure_name not in figures:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(
+            figsize=[round(7.5 * 0.393701, 2), round(9 * 0.393701, 2)])
+        FigureCanvasAgg(fig)
+        figures[figure_name] = (fig, fig.add_subplot(1, 1, 1))
+    fig, ax = figures[figure_name]
+    ax.cla()
+    return fig, ax
 
 
 def multi_xsys_plot(xs,
@@ -7,7 +43,7 @@ def multi_xsys_plot(xs,
                     y_label,
                     title,
                     out_path,
-                    show=False):
+                    dpi=600):
     '''
     Plot multiple x, y arrays on the same axis.
     Args:
@@ -17,14 +53,11 @@ def multi_xsys_plot(xs,
         y_label: <string> y data label (for axis)
         title: <string> axis title
         out_path: <string> path to save figure
-        show: <bool> if true, figure shows, always saves
+        dpi: <int> saved figure resolution in dots per inch
     Returns:
         None
     '''
-    fig, ax = plt.subplots(
-        1,
-        figsize=[round(7.5 * 0.393701, 2), round(9 * 0.393701, 2)],
-        dpi=600)
+    fig, ax = reusable_axes(figure_name='multi_xsys_plot')
     #for x, y in zip(xs, ys):
     #    ax.plot(x, y, lw=2)
     ax.plot(xs[0], ys[0], lw=1)
@@ -50,12 +83,7 @@ def multi_xsys_plot(xs,
         labelsize=10)
     ax.set_xlim(0, 0.1)
     ax.set_ylim(0, 50000)
-    if show:
-        plt.show()
-    plt.savefig(out_path, bbox_inches='tight')
-    fig.clf()
-    plt.cla()
-    plt.close(fig)
+    fig.savefig(out_path, dpi=dpi, bbox_inches='tight')
 
 
 def multiy_plot(ys,
@@ -63,7 +91,7 @@ def multiy_plot(ys,
                 y_label,
                 title,
                 out_path,
-                show=False):
+                dpi=600):
     '''
     Plot multiple y arrays on the same axis.
     Args:
@@ -72,14 +100,11 @@ def multiy_plot(ys,
         y_label: <string> y data label (for axis)
         title: <string> axis title
         out_path: <string> path to save figure
-        show: <bool> if true, figure shows, always saves
+        dpi: <int> saved figure resolution in dots per inch
     Returns:
         None
     '''
-    fig, ax = plt.subplots(
-        1,
-        figsize=[round(7.5 * 0.393701, 2), round(9 * 0.393701, 2)],
-        dpi=600)
+    fig, ax = reusable_axes(figure_name='multiy_plot')
     #for y in ys:
     #    ax.plot(y, lw=2)
     ax.plot(ys[0], lw=1)
@@ -103,9 +128,75 @@ def multiy_plot(ys,
         axis='both',
         colors='black',
         labelsize=10)
-    if show:
-        plt.show()
-    plt.savefig(out_path, bbox_inches='tight')
-    fig.clf()
-    plt.cla()
-    plt.close(fig)
+    fig.savefig(out_path, dpi=dpi, bbox_inches='tight')
+
+
+def timed_plot(plot_function,
+               **kwargs):
+    '''
+    Render a plot, adding its wall time to the process render_time.
+    Args:
+        plot_function: <function> plotting function, e.g. multi_xsys_plot
+        kwargs: plotting function arguments
+    Returns:
+        None
+    '''
+    global render_time
+    start = time.perf_counter()
+    try:
+        plot_function(**kwargs)
+    finally:
+        render_time += time.perf_counter() - start
+
+
+def plot_finished(future):
+    '''
+    Free a background plotting slot and report any plotting error.
+    Args:
+        future: <Future> finished plot
+    Returns:
+        None
+    '''
+    plot_slots.release()
+    if future.exception() is not None:
+        error = future.exception()
+        print(f'Plot failed: {type(error).__name__}: {error}')
+
+
+def submit_plot(plot_function,
+                **kwargs):
+    '''
+    Render a plot on the background plotting thread so the analysis carries on
+    while the figure is drawn and saved. At most 16 plots wait at once, the
+    caller blocks until a slot is free. Pending plots are finished before the
+    process exits, or wait_for_plots can be called.
+    Args:
+        plot_function: <function> plotting function, e.g. multi_xsys_plot
+        kwargs: plotting function arguments, arrays must not be changed after
+                submitting
+    Returns:
+        None
+    '''
+    global plot_executor
+    if plot_executor is None:
+        plot_executor = ThreadPoolExecutor(max_workers=1)
+    plot_slots.acquire()
+    future = plot_executor.submit(
+        timed_plot,
+        plot_function=plot_function,
+        **kwargs)
+    future.add_done_callback(plot_finished)
+
+
+def wait_for_plots():
+    '''
+    Wait for every submitted plot to be saved.
+    Args:
+        None
+    Returns:
+        None
+    '''
+    global plot_executor
+    if plot_executor is not None:
+        plot_executor.shutdown(wait=True)
+        plot_executor = None
@@ -0,0 +1,100 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+from pathlib import Path
+from src.cache import evict_cache, new_file_mode
+
+
+def staged_file_path(stage_path,
+                     file_path,
+                     status):
+    '''
+    Local staging path of a source file. Staged copies are keyed by the
+    source path, size and modification time, so a changed source file is
+    staged again and the stale copy is left for eviction.
+    Args:
+        stage_path: <string> path to local staging directory
+        file_path: <string> path to source file
+        status: <stat_result> os.stat of the source file
+    Returns:
+        staged_path: <Path> path of the staged copy
+    '''
+    key = hashlib.sha256(
+        f'{os.path.abspath(file_path)} {status.st_size} {status.st_mtime_ns}'
+        .encode()).hexdigest()
+    return Path(f'{stage_path}/{key}.stage')
+
+
+def stage_file(stage_path,
+               file_path,
+               status=None):
+    '''
+    Read-through local copy of a source file, e.g. on a network share. A
+    staged copy that is still current is used (and marked as recently used),
+    otherwise the source is copied to a temporary file and renamed into
+    place, so parallel workers never read a partly copied file. The stage is
+    not evicted here, as scanning the stage after every copy is slow, the
+    caller evicts it with evict_cache (e.g. once a batch).
+    Args:
+        stage_path: <string> path to local staging directory
+        file_path: <string> path to source file
+        status: <stat_result> os.stat of the source file, read if None
+    Returns:
+        staged_path: <Path> path of the local copy, read it instead of
+                        file_path
+    '''
+    if status is None:
+        status = os.stat(file_path)
+    staged_path = staged_file_path(
+        stage_path=stage_path,
+        file_path=file_path,
+        status=status)
+    try:
+        os.utime(staged_path)
+        return staged_path
+    except OSError:
+        pass
+    os.makedirs(stage_path, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=stage_path,
+        suffix='.tmp')
+    with os.fdopen(file_descriptor, 'wb') as outfile:
+        with open(file_path, 'rb') as infile:
+            shutil.copyfileobj(infile, outfile, 2 ** 20)
+    os.chmod(temporary_path, new_file_mode)
+    os.replace(temporary_path, staged_path)
+    return staged_path
+
+
+def stage_directory(stage_path,
+                    directory_path,
+                    file_strings,
+                    stage_size=1E10):
+    '''
+    Stage every matching file in a source directory in one pass: the
+    directory is listed once (the listing carries each file's size and
+    modification time), files already staged are skipped, and the stage is
+    evicted once at the end rather than after every copy.
+    Args:
+        stage_path: <string> path to local staging directory
+        directory_path: <string> path to source directory
+        file_strings: <array> file extensions to stage, e.g. [".bmp", ".txt"]
+        stage_size: <int> maximum staging directory size in bytes
+    Returns:
+        staged_paths: <dict> source file path string: staged path
+    '''
+    staged_paths = {}
+    for entry in os.scandir(directory_path):
+        if entry.is_file() and entry.name.endswith(tuple(file_strings)):
+            staged_paths[entry.path] = stage_file(
+                stage_path=stage_path,
+                file_path=entry.path,
+                status=entry.stat())
+    if len(staged_paths) > 0:
+        evict_cache(
+            cache_path=stage_path,
+            cache_size=stage_size,
+            file_string='.stage')
+    return staged_paths
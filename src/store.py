@@ -0,0 +1,270 @@
+import os
+import time
+import sqlite3
+
+from pathlib import Path
+from src.fileIO import load_json
+
+
+''' Image table columns: SQL type '''
+image_columns = {
+    'batch_name': 'TEXT NOT NULL',
+    'file_name': 'TEXT',
+    'file_path': 'TEXT NOT NULL',
+    'primary_string': 'TEXT',
+    'secondary_string': 'TEXT',
+    'design_period': 'INTEGER',
+    'threshold_method': 'TEXT',
+    'grating_period': 'REAL',
+    'period_error': 'REAL',
+    'fill_factor': 'REAL',
+    'fill_factor_error': 'REAL',
+    'acceleration_voltage': 'REAL',
+    'emission_current': 'REAL',
+    'brightness': 'INTEGER',
+    'contrast': 'INTEGER',
+    'magnification': 'INTEGER',
+    'working_distance': 'REAL',
+    'calibration_pixels': 'INTEGER',
+    'calibration_distance': 'INTEGER',
+    'distance_unit': 'TEXT',
+    'image_width': 'INTEGER',
+    'image_height': 'INTEGER',
+    'image_time': 'REAL',
+    'analysed_time': 'REAL'}
+
+''' Batch table columns: SQL type '''
+batch_columns = {
+    'batch_name': 'TEXT NOT NULL',
+    'grating': 'TEXT NOT NULL',
+    'number_of_images': 'INTEGER',
+    'average_period': 'REAL',
+    'period_error': 'REAL',
+    'analysed_time': 'REAL'}
+
+''' Indexed image columns, the usual query filters '''
+image_indexes = [
+    'batch_name',
+    'secondary_string',
+    'design_period',
+    'acceleration_voltage',
+    'magnification',
+    'working_distance',
+    'image_time']
+
+
+def connect_store(store_path):
+    '''
+    Open the results store, a SQLite database with one row per analysed image
+    and one row per batch grating average. Tables and indexes are created if
+    the store is new.
+    Args:
+        store_path: <string> path to results store file
+    Returns:
+        connection: <sqlite3.Connection> open store connection
+    '''
+    os.makedirs(Path(store_path).parent, exist_ok=True)
+    connection = sqlite3.connect(f'{store_path}')
+    connection.row_factory = sqlite3.Row
+    image_table = ', '.join(
+        f'{column} {sql_type}' for column, sql_type in image_columns.items())
+    batch_table = ', '.join(
+        f'{column} {sql_type}' for column, sql_type in batch_columns.items())
+    with connection:
+        connection.execute(
+            f'CREATE TABLE IF NOT EXISTS images ({image_table}, '
+            'UNIQUE (batch_name, file_path))')
+        connection.execute(
+            f'CREATE TABLE IF NOT EXISTS batches ({batch_table}, '
+            'UNIQUE (batch_name, grating))')
+        for column in image_indexes:
+            connection.execute(
+                f'CREATE INDEX IF NOT EXISTS images_{column} '
+                f'ON images ({column})')
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS batches_grating ON batches (grating)')
+    return connection
+
+
+def image_time(file_path):
+    '''
+    Acquisition time of an image, taken as its file modification time.
+    Args:
+        file_path: <string> path to image file
+    Returns:
+        image_time: <float> unix time, None if the file is not found
+    '''
+    try:
+        return os.path.getmtime(file_path)
+    except OSError:
+        return None
+
+
+def batch_rows(batch_dictionary,
+               analysed_time):
+    '''
+    Flatten a batch results dictionary (the _Period.json layout) into image
+    and batch table rows. Images without results (no log file or a failed
+    analysis) are left out.
+    Args:
+        batch_dictionary: <dict> batch results dictionary, as returned by
+                            batch_grating_frequency
+        analysed_time: <float> unix time the batch was analysed
+    Returns:
+        images: <array> image table rows as dictionaries
+        batches: <array> batch table rows as dictionaries
+    '''
+    parent = [
+        key[: -len(' Batch Name')] for key in batch_dictionary
+        if key.endswith(' Batch Name')][0]
+    batch_name = batch_dictionary[f'{parent} Batch Name']
+    images = []
+    gratings = {}
+    for secondary in batch_dictionary[f'{parent} Secondary String']:
+        if f'{secondary} Grating Period' not in batch_dictionary:
+            continue
+        image = batch_dictionary[f'{secondary} Image']
+        log = batch_dictionary[f'{secondary} Log']
+        design_period = image.get(f'{parent} Design Period', 'None')
+        row = {
+            'batch_name': batch_name,
+            'file_name': image.get(f'{parent} File Name'),
+            'file_path': image.get(f'{parent} File Path'),
+            'primary_string': image.get(f'{parent} Primary String'),
+            'secondary_string': secondary,
+            'design_period': (
+                int(design_period) if f'{design_period}'.isdigit() else None),
+            'threshold_method': batch_dictionary.get(
+                f'{secondary} Threshold Method'),
+            'grating_period': batch_dictionary[f'{secondary} Grating Period'],
+            'period_error': batch_dictionary.get(f'{secondary} Period Error'),
+            'fill_factor': batch_dictionary.get(f'{secondary} Fill Factor'),
+            'fill_factor_error': batch_dictionary.get(
+                f'{secondary} Fill Factor Error'),
+            'image_time': image_time(
+                file_path=image.get(f'{parent} File Path')),
+            'analysed_time': analysed_time}
+        row.update({
+            column: log.get(column) for column in image_columns
+            if column in log})
+        images.append(row)
+        grating = secondary.split('_')[0]
+        gratings[grating] = gratings.get(grating, 0) + 1
+    batches = []
+    for grating, number_of_images in gratings.items():
+        average = batch_dictionary.get(f'{grating} Average')
+        batches.append({
+            'batch_name': batch_name,
+            'grating': grating,
+            'number_of_images': number_of_images,
+            'average_period': (
+                average if isinstance(average, (int, float)) else None),
+            'period_error': batch_dictionary.get(f'{grating} Error'),
+            'analysed_time': analysed_time})
+    return images, batches
+
+
+def store_batch_results(store_path,
+                        batch_dictionary,
+                        analysed_time=None):
+    '''
+    Add a batch's results to the results store, replacing any earlier results
+    for the same batch.
+    Args:
+        store_path: <string> path to results store file
+        batch_dictionary: <dict> batch results dictionary, as returned by
+                            batch_grating_frequency
+        analysed_time: <float> unix time the batch was analysed, now if None
+    Returns:
+        None
+    '''
+    if analysed_time is None:
+        analysed_time = time.time()
+    images, batches = batch_rows(
+        batch_dictionary=batch_dictionary,
+        analysed_time=analysed_time)
+    batch_name = [
+        value for key, value in batch_dictionary.items()
+        if key.endswith(' Batch Name')][0]
+    connection = connect_store(store_path=store_path)
+    with connection:
+        for table, columns, rows in [
+                ('images', image_columns, images),
+                ('batches', batch_columns, batches)]:
+            connection.execute(
+                f'DELETE FROM {table} WHERE batch_name = ?',
+                (batch_name, ))
+            connection.executemany(
+                f'INSERT INTO {table} ({", ".join(columns)}) '
+                f'VALUES ({", ".join("?" for _ in columns)})',
+                [[row.get(column) for column in columns] for row in rows])
+    connection.close()
+
+
+def import_json_results(store_path,
+                        results_path):
+    '''
+    Import existing batch results (_Period.json files) into the results
+    store. Each batch's analysed time is its results file modification time.
+    Args:
+        store_path: <string> path to results store file
+        results_path: <string> path to directory of _Period.json files
+    Returns:
+        imported_files: <array> file names of imported results files
+    '''
+    imported = []
+    for file_path in sorted(Path(results_path).glob('*_Period.json')):
+        store_batch_results(
+            store_path=store_path,
+            batch_dictionary=load_json(file_path=file_path),
+            analysed_time=os.path.getmtime(file_path))
+        imported.append(file_path.name)
+    return imported
+
+
+def query_store(store_path,
+                table='images',
+                start_time=None,
+                end_time=None,
+                **filters):
+    '''
+    Query the results store. Filters are column=value pairs, a list value
+    matches any of its values, e.g. query_store(store_path, design_period=400,
+    acceleration_voltage=5.0, start_time=...) for all P400 gratings at 5 kV
+    imaged since start_time.
+    Args:
+        store_path: <string> path to results store file
+        table: <string> "images" or "batches"
+        start_time: <float> earliest unix image time (analysed time for
+                    batches), None for no limit
+        end_time: <float> latest unix image time (analysed time for batches),
+                    None for no limit
+        filters: column name: value or list of values to match
+    Returns:
+        rows: <array> matching rows as dictionaries
+    '''
+    columns = {'images': image_columns, 'batches': batch_columns}[table]
+    time_column = 'image_time' if table == 'images' else 'analysed_time'
+    conditions = []
+    parameters = []
+    for column, value in filters.items():
+        if column not in columns:
+            raise KeyError(f'{table} has no column {column}')
+        values = value if isinstance(value, (list, tuple)) else [value]
+        conditions.append(
+            f'{column} IN ({", ".join("?" for _ in values)})')
+        parameters.extend(values)
+    if start_time is not None:
+        conditions.append(f'{time_column} >= ?')
+        parameters.append(start_time)
+    if end_time is not None:
+        conditions.append(f'{time_column} <= ?')
+        parameters.append(end_time)
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+    connection = connect_store(store_path=store_path)
+    rows = [
+        dict(row) for row in connection.execute(
+            f'SELECT * FROM {table}{where}',
+            parameters)]
+    connection.close()
+    return rows
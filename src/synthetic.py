@@ -0,0 +1,134 @@
+import os
+import numpy as np
+
+from pathlib import Path
+from PIL import Image
+
+
+def synthetic_grating(height,
+                      width,
+                      period,
+                      fill_factor=0.5,
+                      noise=20,
+                      tilt=0,
+                      scum=0,
+                      seed=0):
+    '''
+    Synthetic SEM image of a 1D grating with a known period and fill factor.
+    Lines are bright (200) on a dark (50) background, edges are anti-aliased
+    by averaging 8 sub-pixel samples so non-integer periods are exact. Tilt
+    rotates the lines away from vertical, scum adds bright blobs that cover
+    part of the grating.
+    Args:
+        height: <int> image height in pixels
+        width: <int> image width in pixels
+        period: <float> grating period in pixels
+        fill_factor: <float> fraction of each period covered by a line
+        noise: <float> standard deviation of gaussian pixel noise
+        tilt: <float> line tilt from vertical in degrees
+        scum: <int> number of scum blobs
+        seed: <int> random number generator seed
+    Returns:
+        image: <array> 2D uint8 pixel array
+    '''
+    rng = np.random.default_rng(seed)
+    positions = (
+        np.arange(width)[np.newaxis, :]
+        + np.arange(height)[:, np.newaxis] * np.tan(np.radians(tilt)))
+    coverage = np.zeros((height, width))
+    for sub_pixel in (np.arange(8) + 0.5) / 8:
+        coverage += ((positions + sub_pixel) / period) % 1 < fill_factor
+    image = 50 + 150 * coverage / 8
+    image += rng.normal(0, noise, image.shape)
+    rows, columns = np.mgrid[0: height, 0: width]
+    for _ in range(scum):
+        centre_row, centre_column = rng.uniform([0, 0], [height, width])
+        radius = rng.uniform(0.02, 0.08) * min(height, width)
+        blob = ((rows - centre_row) ** 2 + (columns - centre_column) ** 2
+                < radius ** 2)
+        image[blob] = rng.uniform(180, 255)
+    return np.clip(np.round(image), 0, 255).astype(np.uint8)
+
+
+def JEOL_log_lines(width,
+                   height,
+                   calibration_pixels,
+                   calibration_marker,
+                   acceleration_voltage=5.0,
+                   magnification=50000):
+    '''
+    Lines of a JEOL-style SEM log with the parameters read by
+    fileIO.read_SEM_log.
+    Args:
+        width: <int> image width in pixels
+        height: <int> image height in pixels
+        calibration_pixels: <int> scale bar length in pixels
+        calibration_marker: <string> scale bar length with 2 character unit,
+                            e.g. "1um"
+        acceleration_voltage: <float> acceleration voltage in kV
+        magnification: <int> magnification
+    Returns:
+        lines: <array> log file lines, newline terminated
+    '''
+    return [
+        f'${key} {value}\n' for key, value in [
+            ('CM_ACCEL_VOLT', acceleration_voltage),
+            ('SM_EMI_CURRENT', 10.0),
+            ('CM_BRIGHTNESS', 50),
+            ('CM_CONTRAST', 50),
+            ('CM_MAG', magnification),
+            ('SM_WD', 10.0),
+            ('SM_MICRON_BAR', calibration_pixels),
+            ('SM_MICRON_MARKER', calibration_marker),
+            ('CM_FULL_SIZE', f'{width} {height}')]]
+
+
+def write_synthetic_sample(directory_path,
+                           file_name,
+                           height,
+                           width,
+                           period,
+                           distance_per_pixel=0.005,
+                           databar=64,
+                           **kwargs):
+    '''
+    Save a synthetic grating as a JEOL SEM .bmp image and .txt log pair. A
+    blank databar is added below the image, as on JEOL images, and removed
+    again by analysis.trim_img_to_roi.
+    Args:
+        directory_path: <string> path to save the files (an SEM directory)
+        file_name: <string> file name without extension, e.g. "A1_P250_G1"
+        height: <int> image height in pixels
+        width: <int> image width in pixels
+        period: <float> grating period in nm
+        distance_per_pixel: <float> distance in um per pixel, 1 um scale bar
+                            is 1 / distance_per_pixel pixels (rounded)
+        databar: <int> databar height in pixels
+        kwargs: further synthetic_grating arguments (fill_factor, noise, tilt,
+                scum, seed)
+    Returns:
+        ground_truth: <dict> true grating period (nm), period in pixels, and
+                        fill factor
+    '''
+    calibration_pixels = int(round(1 / distance_per_pixel))
+    distance_per_pixel = 1 / calibration_pixels
+    period_pixels = period / (distance_per_pixel * 1E3)
+    image = np.zeros((height + databar, width), dtype=np.uint8)
+    image[: height] = synthetic_grating(
+        height=height,
+        width=width,
+        period=period_pixels,
+        **kwargs)
+    os.makedirs(directory_path, exist_ok=True)
+    Image.fromarray(image).save(Path(f'{directory_path}/{file_name}.bmp'))
+    with open(Path(f'{directory_path}/{file_name}.txt'), 'w') as outfile:
+        outfile.writelines(
+            JEOL_log_lines(
+                width=width,
+                height=height,
+                calibration_pixels=calibration_pixels,
+                calibration_marker='1um'))
+    return {
+        'period': period,
+        'period_pixels': period_pixels,
+        'fill_factor': kwargs.get('fill_factor', 0.5)}
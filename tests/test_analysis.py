@@ -0,0 +1,42 @@
+import numpy as np
+import src.analysis as anal
+
+
+def test_region_fftsignalprocessing_matches_scipy_on_prominence_ties():
+    generator = np.random.default_rng(0)
+    absolute_intensities = generator.integers(
+        0, 4, size=(300, 64)).astype(float)
+    frequency_coordinates = np.fft.rfftfreq(126, 1)
+    frequencies, periods = anal.region_fftsignalprocessing(
+        frequency_coordinates=frequency_coordinates,
+        absolute_intensities=absolute_intensities,
+        micrometers_per_pixel=0.01,
+        sample_size=126,
+        number_of_frequencies=5)
+    for row, absolute_intensity in enumerate(absolute_intensities):
+        row_frequencies, row_periods = anal.row_fftsignalprocessing(
+            frequency_coordinates=frequency_coordinates,
+            absolute_intensity=absolute_intensity,
+            micrometers_per_pixel=0.01,
+            sample_size=126,
+            number_of_frequencies=5)
+        found = len(row_periods)
+        np.testing.assert_allclose(periods[row, :found], row_periods)
+        np.testing.assert_allclose(frequencies[row, :found], row_frequencies)
+        assert np.all(np.isnan(periods[row, found:]))
+
+
+def test_region_fftsignalprocessing_narrow_region():
+    region = np.tile([0, 255, 255, 0, 0, 255], (4, 1))
+    sample_size, frequency_coordinates, absolute_intensities = (
+        anal.calc_region_freqs(region=region))
+    frequencies, periods = anal.region_fftsignalprocessing(
+        frequency_coordinates=frequency_coordinates,
+        absolute_intensities=absolute_intensities,
+        micrometers_per_pixel=0.01,
+        sample_size=sample_size,
+        number_of_frequencies=5)
+    assert len(frequency_coordinates) < 5
+    assert np.shape(periods) == (4, 5)
+    assert np.shape(frequencies) == (4, 5)
+    assert np.all(np.isnan(periods[:, 1:]))
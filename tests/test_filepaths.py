@@ -0,0 +1,22 @@
+import src.filepaths as fp
+
+
+def test_build_log_index_skips_stray_text_files(tmp_path, capsys):
+    sem_path = tmp_path / 'SEM'
+    sem_path.mkdir()
+    (sem_path / 'B0_P400_G0.txt').write_text('')
+    (sem_path / 'notes.txt').write_text('')
+    (sem_path / 'readme_.txt').write_text('')
+    log_index = fp.build_log_index(log_path=sem_path, file_string='.txt')
+    assert list(log_index) == [('B0', 'P400_G0')]
+    output = capsys.readouterr().out
+    assert 'notes: not a sample log, skipped' in output
+    assert 'readme_: not a sample log, skipped' in output
+
+
+def test_index_log_file_skips_stray_text_file(tmp_path):
+    sem_path = tmp_path / 'SEM'
+    sem_path.mkdir()
+    log_index = {}
+    fp.index_log_file(log_index=log_index, file_path=sem_path / 'notes.txt')
+    assert log_index == {}
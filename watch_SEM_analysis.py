@@ -0,0 +1,421 @@
+import os
+import time
+import src.fileIO as io
+import src.filepaths as fp
+import src.analysis as anal
+import src.plotting as plot
+import src.instrument as instrument
+
+from pathlib import Path
+from batch_SEM_analysis import (
+    batch_stream_record,
+    evict_directories,
+    image_record,
+    isolated_image_grating_frequency,
+    rebuild_batch_dictionary,
+    unchanged_image)
+
+
+def poll_directory(directory_path,
+                   file_strings):
+    '''
+    Size and modification time of every matching file in a directory, from a
+    single directory listing.
+    Args:
+        directory_path: <string> path to directory
+        file_strings: <array> file extensions to include, e.g. [".bmp"]
+    Returns:
+        file_status: <dict> file path string: (size, modification time)
+    '''
+    file_status = {}
+    for entry in os.scandir(directory_path):
+        if entry.name.endswith(tuple(file_strings)):
+            try:
+                status = entry.stat()
+            except OSError:
+                continue
+            file_status[entry.path] = (status.st_size, status.st_mtime_ns)
+    return file_status
+
+
+def complete_files(previous_status,
+                   file_status):
+    '''
+    Files that are fully written: not empty, and the same size and
+    modification time as at the previous poll.
+    Args:
+        previous_status: <dict> poll_directory result of the previous poll
+        file_status: <dict> poll_directory result of this poll
+    Returns:
+        file_paths: <array> sorted complete file path strings
+    '''
+    return sorted(
+        file for file, status in file_status.items()
+        if status[0] > 0 and previous_status.get(file) == status)
+
+
+def load_live_batch(stream_path,
+                    settings):
+    '''
+    Images already analysed for a batch, read back from its results stream
+    if the stream was written with the same settings and analysis code, so a
+    restarted watcher carries on without analysing them again. Images that
+    have changed since they were recorded are left out, to be analysed again.
+    Args:
+        stream_path: <string> path to results stream file
+        settings: <dict> "Settings" entry of this run's batch record
+    Returns:
+        batch_images: <dict> file path string: (image_dictionary,
+                        period_dictionary, timing_dictionary), None if the
+                        stream is missing or can not be carried on
+    '''
+    if not Path(stream_path).is_file():
+        return None
+    records = io.load_json_records(file_path=stream_path)
+    batch_records = [
+        index for index, record in enumerate(records) if 'Batch' in record]
+    if len(batch_records) == 0:
+        return None
+    if records[batch_records[-1]]['Settings'] != settings:
+        return None
+    return {
+        record['File Path']: (
+            record['Image'],
+            record['Periods'],
+            record.get('Timing', {}))
+        for record in records[batch_records[-1]:]
+        if 'File Path' in record and unchanged_image(record=record)}
+
+
+def start_live_batch(parent_directory,
+                     batch_name,
+                     stream_path,
+                     settings):
+    '''
+    Start a new results stream for a batch, replacing any stream that can not
+    be carried on. The batch record lists no files, as the images are not
+    known until they are saved, image records are appended as they are
+    analysed.
+    Args:
+        parent_directory: <string> parent directory identifier
+        batch_name: <string> batch name string
+        stream_path: <string> path to results stream file
+        settings: <dict> plot_files, spectrum_mode and fill_factor, see
+                    batch_stream_record
+    Returns:
+        None
+    '''
+    io.save_json_records(
+        out_path=stream_path,
+        records=[batch_stream_record(
+            batch_dictionary=fp.update_batch_dictionary(
+                parent=parent_directory,
+                batch_name=batch_name,
+                file_paths=[]),
+            file_paths=[],
+            **settings)])
+
+
+def append_live_image(stream_path,
+                      file_path,
+                      image_results,
+                      average_dictionary):
+    '''
+    Append an analysed image and the updated batch averages to a batch's
+    results stream. Only the new records are written, so the cost per image
+    does not grow with the batch and a crash loses at most the image being
+    written. The last summary record in the stream is the current one.
+    Args:
+        stream_path: <string> path to results stream file
+        file_path: <string> path to image file
+        image_results: <tuple> image results, see load_live_batch
+        average_dictionary: <dict> batch average grating periods, see
+                            anal.grating_aggregate_results
+    Returns:
+        None
+    '''
+    io.append_json_record(
+        out_path=stream_path,
+        record=image_record(file_path=file_path, image_results=image_results))
+    io.append_json_record(
+        out_path=stream_path,
+        record={'Summary': average_dictionary})
+
+
+def save_live_batch(parent_directory,
+                    batch_name,
+                    batch_images,
+                    average_dictionary,
+                    results_path,
+                    settings):
+    '''
+    Write a batch's "_Period.json" results dictionary for the images analysed
+    so far, in the same layout (and file order) as batch_SEM_analysis.py.
+    Args:
+        parent_directory: <string> parent directory identifier
+        batch_name: <string> batch name string
+        batch_images: <dict> file path string: image results, see
+                        load_live_batch
+        average_dictionary: <dict> batch average grating periods, see
+                            anal.grating_aggregate_results
+        results_path: <string> path to results directory
+        settings: <dict> plot_files, spectrum_mode and fill_factor, see
+                    batch_stream_record
+    Returns:
+        None
+    '''
+    file_paths = sorted(batch_images)
+    records = (
+        [batch_stream_record(
+            batch_dictionary=fp.update_batch_dictionary(
+                parent=parent_directory,
+                batch_name=batch_name,
+                file_paths=file_paths),
+            file_paths=file_paths,
+            **settings)]
+        + [
+            image_record(file_path=file, image_results=batch_images[file])
+            for file in file_paths]
+        + [{'Summary': average_dictionary}])
+    io.save_json_dicts(
+        out_path=Path(f'{results_path}/{batch_name}_Period.json'),
+        dictionary=rebuild_batch_dictionary(records=records))
+
+
+def restore_live_batches(results_path,
+                         settings):
+    '''
+    Rewrite the "_Period.json" results dictionary of every batch whose
+    watcher results stream is newer than it, e.g. after the watcher was
+    killed before it could write them. Streams written by batch runs (their
+    batch record lists the batch files) already have their results written.
+    Args:
+        results_path: <string> path to results directory
+        settings: <dict> plot_files, spectrum_mode and fill_factor, see
+                    batch_stream_record
+    Returns:
+        None
+    '''
+    for stream_path in sorted(Path(results_path).glob('*_Period.ndjson')):
+        out_path = stream_path.with_suffix('.json')
+        if (out_path.is_file()
+                and out_path.stat().st_mtime_ns
+                >= stream_path.stat().st_mtime_ns):
+            continue
+        records = io.load_json_records(file_path=stream_path)
+        batch_records = [
+            index for index, record in enumerate(records)
+            if 'Batch' in record]
+        if len(batch_records) == 0 or records[batch_records[-1]]['File Paths']:
+            continue
+        batch_images = {
+            record['File Path']: (
+                record['Image'],
+                record['Periods'],
+                record.get('Timing', {}))
+            for record in records[batch_records[-1]:]
+            if 'File Path' in record}
+        if len(batch_images) == 0:
+            continue
+        sample_parameters = fp.sample_information(
+            file_path=min(batch_images))
+        parent = sample_parameters['Parent Directory']
+        aggregate = {}
+        for image_results in batch_images.values():
+            for period_key, period in image_results[1].items():
+                anal.add_grating_period(
+                    aggregate=aggregate,
+                    period_key=period_key,
+                    period=period)
+        save_live_batch(
+            parent_directory=parent,
+            batch_name=sample_parameters[f'{parent} Primary String'],
+            batch_images=batch_images,
+            average_dictionary=anal.grating_aggregate_results(
+                aggregate=aggregate),
+            results_path=results_path,
+            settings=settings)
+
+
+def watch_directory(directory_paths,
+                    settings,
+                    image_arguments,
+                    cache_size=1E9,
+                    stage_size=1E10,
+                    poll_interval=0.2,
+                    maximum_polls=None):
+    '''
+    Watch the SEM directory and analyse each image as soon as it and its log
+    file are fully written. Each new image is analysed once and added to its
+    batch's running grating aggregate (anal.add_grating_period), so earlier
+    images are neither analysed nor averaged again. The image and the updated
+    batch averages are appended to the batch's results stream, and the
+    image's period and grating average are printed. Images already in a
+    batch's results stream are not analysed again. The batch results
+    dictionaries are written when the watcher stops, and on starting, any
+    left out of date by a watcher that was killed are rewritten from their
+    streams (restore_live_batches).
+    Args:
+        directory_paths: <dict> dictionary containing required paths
+        settings: <dict> plot_files, spectrum_mode and fill_factor, see
+                    batch_stream_record
+        image_arguments: <dict> remaining image_grating_frequency arguments
+                            (plot_dpi, plot_methods)
+        cache_size: <int> maximum result cache size in bytes, the cache (and
+                    staging directory) is evicted after each poll that
+                    analysed images, see evict_directories
+        stage_size: <int> maximum staging directory size in bytes, used if
+                    directory_paths has a "Stage Path"
+        poll_interval: <float> time between directory polls in seconds
+        maximum_polls: <int> number of polls before returning, None watches
+                        until interrupted
+    Returns:
+        None
+    '''
+    sem_path = directory_paths['SEM Path']
+    results_path = directory_paths['Results Path']
+    restore_live_batches(
+        results_path=results_path,
+        settings=settings)
+    expected_settings = batch_stream_record(
+        batch_dictionary={},
+        file_paths=[],
+        **settings)['Settings']
+    log_index = {}
+    indexed_logs = set()
+    batches = {}
+    parents = {}
+    aggregates = {}
+    updated = set()
+    previous_status = {}
+    polls = 0
+    try:
+        while maximum_polls is None or polls < maximum_polls:
+            polls += 1
+            file_status = poll_directory(
+                directory_path=sem_path,
+                file_strings=['.bmp', '.txt'])
+            complete = complete_files(
+                previous_status=previous_status,
+                file_status=file_status)
+            previous_status = file_status
+            analysed = False
+            for file in complete:
+                if file.endswith('.txt') and file not in indexed_logs:
+                    fp.index_log_file(
+                        log_index=log_index,
+                        file_path=Path(file))
+                    indexed_logs.add(file)
+            for file in complete:
+                if not file.endswith('.bmp'):
+                    continue
+                sample_parameters = fp.sample_information(file_path=file)
+                if len(sample_parameters) == 0:
+                    continue
+                parent = sample_parameters['Parent Directory']
+                batch_name = sample_parameters[f'{parent} Primary String']
+                log_key = (
+                    batch_name,
+                    sample_parameters[f'{parent} Secondary String'])
+                stream_path = Path(
+                    f'{results_path}/{batch_name}_Period.ndjson')
+                if batch_name not in batches:
+                    batch_images = load_live_batch(
+                        stream_path=stream_path,
+                        settings=expected_settings)
+                    if batch_images is None:
+                        start_live_batch(
+                            parent_directory=parent,
+                            batch_name=batch_name,
+                            stream_path=stream_path,
+                            settings=settings)
+                        batch_images = {}
+                    batches[batch_name] = batch_images
+                    parents[batch_name] = parent
+                    aggregates[batch_name] = {}
+                    for image_results in batch_images.values():
+                        for period_key, period in image_results[1].items():
+                            anal.add_grating_period(
+                                aggregate=aggregates[batch_name],
+                                period_key=period_key,
+                                period=period)
+                if file in batches[batch_name] or log_key not in log_index:
+                    continue
+                image_results = isolated_image_grating_frequency(
+                    file_path=file,
+                    parent_directory=parent,
+                    batch_name=batch_name,
+                    directory_paths=directory_paths,
+                    log_index=log_index,
+                    **settings,
+                    **image_arguments)
+                batches[batch_name][file] = image_results
+                for period_key, period in image_results[1].items():
+                    anal.add_grating_period(
+                        aggregate=aggregates[batch_name],
+                        period_key=period_key,
+                        period=period)
+                average_dictionary = anal.grating_aggregate_results(
+                    aggregate=aggregates[batch_name])
+                append_live_image(
+                    stream_path=stream_path,
+                    file_path=file,
+                    image_results=image_results,
+                    average_dictionary=average_dictionary)
+                updated.add(batch_name)
+                analysed = True
+                secondary_string = log_key[1]
+                period = image_results[1].get(secondary_string)
+                grating = anal.grating_key(period_key=secondary_string)
+                print(
+                    f'{batch_name} {secondary_string}: period {period}, '
+                    f'{grating} average '
+                    f'{average_dictionary.get(f"{grating} Average")}')
+            if analysed:
+                evict_directories(
+                    directory_paths=directory_paths,
+                    cache_size=cache_size,
+                    stage_size=stage_size)
+            time.sleep(poll_interval)
+    finally:
+        for batch_name in sorted(updated):
+            save_live_batch(
+                parent_directory=parents[batch_name],
+                batch_name=batch_name,
+                batch_images=batches[batch_name],
+                average_dictionary=anal.grating_aggregate_results(
+                    aggregate=aggregates[batch_name]),
+                results_path=results_path,
+                settings=settings)
+
+
+if __name__ == '__main__':
+
+    ''' Organisation '''
+    root = Path().absolute()
+    info, directory_paths = fp.get_directory_paths(root_path=root)
+    os.makedirs(directory_paths['Results Path'], exist_ok=True)
+
+    '''
+    Watch the SEM directory, "Watch Interval" (seconds) in info.json sets the
+    time between directory polls, stop with Ctrl+C. "Trace Memory" "True"
+    adds each stage's peak memory to the timings
+    '''
+    if info.get('Trace Memory', 'False') == 'True':
+        instrument.start_memory_tracing()
+    try:
+        watch_directory(
+            directory_paths=directory_paths,
+            settings={
+                'plot_files': info['Plot Files'],
+                'spectrum_mode': info.get('Spectrum Mode', 'Rows'),
+                'fill_factor': info.get('Fill Factor', 'False')},
+            image_arguments={
+                'plot_dpi': int(info.get('Plot DPI', 600)),
+                'plot_methods': info.get('Plot Methods', 'All')},
+            cache_size=float(info.get('Cache Size', 1000)) * 1E6,
+            stage_size=float(info.get('Stage Size', 10000)) * 1E6,
+            poll_interval=float(info.get('Watch Interval', 0.2)))
+    except KeyboardInterrupt:
+        pass
+    plot.wait_for_plots()